@@ -0,0 +1,82 @@
+# Times the sample specifications with an empty disk cache (cold) and again once the
+# font index and text measurements from the first run are cached (warm). Every run is
+# a fresh process, so nothing carries over in memory. Outputs are written to a
+# temporary directory with the fast encode preset, since encoding isn't affected by
+# the cache.
+#
+#   python benchmarks/bench_cache.py
+#   python benchmarks/bench_cache.py --repeat 5
+
+import argparse
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+import toml
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "capper"))
+
+from pretty_logging import Logging
+
+SPECS = [ROOT / "samples" / "getting-started" / "spec.toml",
+         ROOT / "samples" / "banner" / "spec.toml"]
+# Stages that run before anything is drawn
+LAYOUT_STAGES = ["Spec validation", "Font indexing", "Font loading", "Parsing",
+                 "Measuring", "Wrapping", "Splitting", "Rescaling", "Saving metrics"]
+
+def writeSpec(specFile, workDir):
+    with open(specFile, "r", encoding="utf-8") as f:
+        spec = toml.load(f)
+    spec["output"]["output_directory"] = workDir
+    spec["output"]["outputs"] = ["caption"]
+    spec["output"]["encode_preset"] = "fast"
+    benchSpecFile = (Path(workDir) / f"{specFile.parent.name}.toml").as_posix()
+    with open(benchSpecFile, "w", encoding="utf-8") as f:
+        toml.dump(spec, f)
+    return benchSpecFile
+
+def timeRun(specFile, cacheDir, workDir):
+    # Returns (wall seconds, layout seconds, font loads) of one run in a new process
+    profileJson = (Path(workDir) / "profile.json").as_posix()
+    env = dict(os.environ, CAPPER_CACHE_DIR=cacheDir, CAPPER_DISK_CACHE="1")
+    startTime = time.perf_counter()
+    subprocess.run([sys.executable, (ROOT / "capper" / "caption.py").as_posix(),
+                    specFile, "--profile_json", profileJson],
+                   cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - startTime
+    with open(profileJson, "r", encoding="utf-8") as f:
+        stages = json.load(f)["stages"]
+    layout = sum([stages[stage]["wall_s"] for stage in LAYOUT_STAGES if stage in stages])
+    fontLoads = stages.get("Font loading", {}).get("calls", 0)
+    return (wall, layout, fontLoads)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Capper with a cold and a " \
+                                     "warm disk cache")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of each " \
+                        "run. The fastest is reported.")
+    args = parser.parse_args()
+
+    Logging.header(f"Benchmarking the disk cache ({args.repeat} repetitions per run)")
+    table = [("Specification", "Run", "Wall", "Layout", "Font Loads")]
+    with tempfile.TemporaryDirectory() as workDir:
+        for specFile in SPECS:
+            benchSpecFile = writeSpec(specFile, workDir)
+            runs = {"cold" : [], "warm" : []}
+            for i in range(args.repeat):
+                cacheDir = (Path(workDir) / f"cache{i}").as_posix()
+                runs["cold"].append(timeRun(benchSpecFile, cacheDir, workDir))
+                runs["warm"].append(timeRun(benchSpecFile, cacheDir, workDir))
+            for (run, results) in runs.items():
+                (walls, layouts, fontLoads) = zip(*results)
+                table.append((specFile.parent.name, run, f"{min(walls):.3f}s",
+                              f"{min(layouts):.3f}s", max(fontLoads)))
+    Logging.table(table)
+    Logging.divider()
+
+if __name__ == "__main__":
+    main()
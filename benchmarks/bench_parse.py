@@ -0,0 +1,63 @@
+# Times `parseText()` on synthetic text of increasing size to show that tokenizing
+# scales linearly with the length of the text file.
+#
+#   python benchmarks/bench_parse.py
+
+from pathlib import Path
+import random
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "capper"))
+
+from fonts import Font, MeasureCache
+from pretty_logging import Logging
+from text import parseText
+
+WORDS = ["the", "old", "man", "said", "nothing", "paw", "monkey's", "wish", "door",
+         "night", "*bold*", "_italic_", "_*both*_", "[b]switch[a]", "\\*escaped\\_"]
+
+def syntheticText(numBytes, seed=0):
+    rng = random.Random(seed)
+    words = []
+    size = 0
+    while size < numBytes:
+        word = rng.choice(WORDS)
+        if rng.random() < 0.05:
+            word += "\n\n"
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+def benchFonts():
+    fonts = {}
+    for name in ["a", "b"]:
+        fonts[name] = {}
+        for (variant, fileName) in [("font", "NotoSans-Regular.ttf"),
+                                    ("font_bold", "NotoSans-Bold.ttf"),
+                                    ("font_italic", "NotoSans-Italic.ttf"),
+                                    ("font_bolditalic", "NotoSans-BoldItalic.ttf")]:
+            path = (ROOT / "fonts" / "Noto_Sans" / fileName).as_posix()
+            fonts[name][variant] = Font(path, 16, "#FFFFFFFF", 0, "#000000FF")
+    return fonts
+
+def main():
+    fonts = benchFonts()
+    Logging.header("Benchmarking parseText()")
+    table = [("Input Size", "Words", "Time", "Time per KB")]
+    Logging.quiet = True
+    for numBytes in [1 << 14, 1 << 16, 1 << 18, 1 << 20]:
+        text = syntheticText(numBytes)
+        MeasureCache.clear()
+        startTime = time.perf_counter()
+        fmtWords = parseText(text, fonts, "a")
+        duration = time.perf_counter() - startTime
+        table.append((f"{numBytes >> 10} KB", len(fmtWords), f"{duration:.3f}s",
+                      f"{1e6 * duration / (numBytes >> 10):.1f}us"))
+    Logging.quiet = False
+    Logging.table(table)
+    Logging.divider()
+
+if __name__ == "__main__":
+    main()
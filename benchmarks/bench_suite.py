@@ -0,0 +1,275 @@
+# Times each stage of rendering, and whole renders, on synthetic captions of
+# increasing size. The captions mix characters, bold and italic markup, and emoji, and
+# are rendered with the bundled Noto fonts and sample art, so the suite runs offline.
+#
+# Results are saved to a JSON file keyed by the commit they were measured at. Passing
+# --baseline compares the run against an earlier commit's results and exits with an
+# error if any stage got slower by more than --threshold.
+#
+#   python benchmarks/bench_suite.py
+#   python benchmarks/bench_suite.py --sizes 100 1000 --baseline 1a2b3c4 --threshold 0.1
+
+import argparse
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import toml
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "capper"))
+# Text lengths cached on disk by earlier runs would make every run warm. See
+# bench_cache.py for the difference the cache makes.
+os.environ["CAPPER_DISK_CACHE"] = "0"
+
+from caption import renderSpec
+from fonts import MeasureCache, loadFonts
+from pretty_logging import Logging
+from profiling import Profiler
+from render import Renderer, autoWidth
+from spec_parse import UserSpec
+from text import parseText, wrapRegions, wrapRegionsOptimal, LineCache, TextBox
+
+WORDS = ["the", "old", "man", "said", "nothing", "paw", "monkey's", "wish", "door",
+         "night", "fire", "and", "of", "a", "wanted", "quietly", "two", "hundred",
+         "pounds", "sergeant-major", "it's", "mother", "\"Well,\"", "(again)", "rain."]
+EMOJI = ["🐒", "🔥", "💀", "✨", "🙏"]
+
+# Stages timed on their own, in the order they run
+STAGES = ["parse", "wrap", "wrap_optimal", "split", "layout", "draw", "encode",
+          "end_to_end"]
+# Stages faster than this are too noisy to flag as regressions
+NOISE_FLOOR = 0.002
+
+def syntheticText(numWords, seed=0):
+    rng = random.Random(seed)
+    words = []
+    for _ in range(numWords):
+        word = rng.choice(WORDS)
+        roll = rng.random()
+        if roll < 0.04:
+            word = f"*{word}*"
+        elif roll < 0.08:
+            word = f"_{word}_"
+        elif roll < 0.09:
+            word = f"_*{word}*_"
+        elif roll < 0.11:
+            word = f"[sans]{word}[serif]"
+        elif roll < 0.12:
+            word = f"[em]{rng.choice(EMOJI)}[serif]"
+        if rng.random() < 0.02:
+            word += "\n\n"
+        words.append(word)
+    return "[serif]" + " ".join(words)
+
+def syntheticSpec(textFile, outputDirectory):
+    return {
+        "image" : {
+            "art" : (ROOT / "samples" / "getting-started" / "img.jpg").as_posix(),
+            "bg_color" : "#54130C",
+        },
+        "text" : {
+            "text" : textFile,
+            "text_box_pos" : "split",
+            "credits" : ["Art by nobody"],
+        },
+        "output" : {
+            "base_filename" : Path(textFile).stem,
+            "output_directory" : outputDirectory,
+            "outputs" : ["caption"],
+            "encode_preset" : "fast",
+        },
+        "characters" : [
+            {"name" : "serif", "color" : "#F0C7C2",
+             "font" : (ROOT / "fonts" / "Noto_Serif" / "NotoSerif-Regular.ttf").as_posix()},
+            {"name" : "sans", "color" : "#C2EFF0", "relative_height" : 0.7,
+             "font" : (ROOT / "fonts" / "Noto_Sans" / "NotoSans-Regular.ttf").as_posix()},
+            {"name" : "em", "color" : "#FFFFFF",
+             "font" : (ROOT / "fonts" / "Noto_Emoji" / "NotoEmoji-Regular.ttf").as_posix()},
+        ],
+    }
+
+def writeCase(workDir, numWords):
+    textFile = (Path(workDir) / f"words{numWords}.txt").as_posix()
+    with open(textFile, "w", encoding="utf-8") as f:
+        f.write(syntheticText(numWords))
+    specFile = (Path(workDir) / f"words{numWords}.toml").as_posix()
+    with open(specFile, "w", encoding="utf-8") as f:
+        toml.dump(syntheticSpec(textFile, workDir), f)
+    return (textFile, specFile)
+
+def timeStages(textFile, specFile):
+    # Returns {stage: seconds} for one repetition. Measurements start from empty
+    # measurement and line caches so that repetitions don't speed each other up.
+    times = {}
+    with open(textFile, "r", encoding="utf-8") as f:
+        text = f.read()
+    spec = UserSpec(specFile)
+    baseHeight = spec.text["base_font_height"]["value"]
+    lineSpacing = int(spec.text["line_spacing"]["value"] * baseHeight)
+    padding = int(spec.text["padding"]["value"] * baseHeight)
+    fonts = loadFonts(spec.characters, baseHeight)
+
+    MeasureCache.clear()
+    startTime = time.perf_counter()
+    fmtWords = parseText(text, fonts, "serif")
+    times["parse"] = time.perf_counter() - startTime
+
+    width = autoWidth(baseHeight, fmtWords, "split")
+    startTime = time.perf_counter()
+    wrapped = wrapRegions(fmtWords, width)
+    times["wrap"] = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    wrapRegionsOptimal(fmtWords, width)
+    times["wrap_optimal"] = time.perf_counter() - startTime
+
+    textBox = TextBox(wrapped, baseHeight, lineSpacing, padding)
+    startTime = time.perf_counter()
+    textBox.split()
+    times["split"] = time.perf_counter() - startTime
+
+    MeasureCache.clear()
+    LineCache.clear()
+    renderer = Renderer(UserSpec(specFile))
+    startTime = time.perf_counter()
+    (textBoxes, art) = renderer.layout()
+    times["layout"] = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    img = renderer.drawCaption(textBoxes, art)
+    times["draw"] = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    renderer.encode(img)
+    times["encode"] = time.perf_counter() - startTime
+
+    MeasureCache.clear()
+    LineCache.clear()
+    startTime = time.perf_counter()
+    renderSpec(specFile)
+    times["end_to_end"] = time.perf_counter() - startTime
+    return times
+
+def commitKey():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               cwd=ROOT, capture_output=True, text=True,
+                               check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+def findBaseline(allResults, baseline):
+    matches = [key for key in allResults if key.startswith(baseline)]
+    if len(matches) != 1:
+        sys.exit(f"Expected exactly one saved result matching '{baseline}', found " \
+                 f"{matches if matches else 'none'}")
+    return matches[0]
+
+def compare(baseResults, results, threshold):
+    table = [("Case", "Stage", "Baseline", "Current", "Change")]
+    regressions = []
+    for (case, stages) in results.items():
+        for (stage, seconds) in stages.items():
+            if case not in baseResults or stage not in baseResults[case]:
+                continue
+            baseSeconds = baseResults[case][stage]
+            change = (seconds - baseSeconds) / baseSeconds if baseSeconds > 0 else 0
+            flag = ""
+            if change > threshold and max(seconds, baseSeconds) >= NOISE_FLOOR:
+                flag = "  REGRESSION"
+                regressions.append((case, stage, change))
+            table.append((case, stage, f"{baseSeconds:.4f}s", f"{seconds:.4f}s",
+                          f"{100 * change:+.1f}%{flag}"))
+    return (table, regressions)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Capper on synthetic captions")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000],
+                        metavar="WORDS", help="Caption sizes to benchmark, in words.")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions per size. " \
+                        "The fastest repetition of each stage is recorded.")
+    parser.add_argument("--results", default=(ROOT / "benchmarks" / "results.json"),
+                        metavar="FILE", help="JSON file results are saved to, keyed by " \
+                        "commit. Defaults to benchmarks/results.json.")
+    parser.add_argument("--baseline", metavar="COMMIT", help="Compare against the " \
+                        "saved results of this commit (or a unique prefix of it).")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Fraction a " \
+                        "stage may slow down by before it counts as a regression. " \
+                        "Defaults to 0.10.")
+    parser.add_argument("--no_save", action="store_true", help="Don't save this run.")
+    args = parser.parse_args()
+
+    allResults = {}
+    if Path(args.results).is_file():
+        with open(args.results, "r", encoding="utf-8") as f:
+            allResults = json.load(f)
+    baselineKey = None if args.baseline is None else findBaseline(allResults, args.baseline)
+
+    key = commitKey()
+    Logging.header(f"Benchmarking commit {key} ({args.repeat} repetitions per size)")
+    results = {}
+    with tempfile.TemporaryDirectory() as workDir:
+        for numWords in args.sizes:
+            (textFile, specFile) = writeCase(workDir, numWords)
+            samples = {stage : [] for stage in STAGES}
+            for _ in range(args.repeat):
+                Logging.quiet = True
+                Profiler.clear()
+                try:
+                    for (stage, seconds) in timeStages(textFile, specFile).items():
+                        samples[stage].append(seconds)
+                finally:
+                    Logging.quiet = False
+            case = f"{numWords} words"
+            results[case] = {stage : round(min(times), 6)
+                             for (stage, times) in samples.items()}
+            Logging.subSection(f"{case}: end to end in {results[case]['end_to_end']:.3f}s " \
+                               f"(median {statistics.median(samples['end_to_end']):.3f}s)")
+
+    table = [["Stage"] + list(results.keys())]
+    for stage in STAGES:
+        table.append([stage] + [f"{results[case][stage]:.4f}s" for case in results])
+    Logging.table(table)
+
+    if not args.no_save:
+        # Runs of other sizes at the same commit are kept
+        savedResults = allResults.get(key, {}).get("results", {})
+        savedResults.update(results)
+        allResults[key] = {
+            "date" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "cpus" : os.cpu_count(),
+            "results" : savedResults,
+        }
+        with open(args.results, "w", encoding="utf-8") as f:
+            json.dump(allResults, f, indent=2)
+        Logging.subSection(f"Saved results for {key} to '{args.results}'")
+
+    exitCode = 0
+    if baselineKey is not None:
+        Logging.header(f"Comparing against {baselineKey} " \
+                       f"(threshold {100 * args.threshold:.0f}%)")
+        (table, regressions) = compare(allResults[baselineKey]["results"], results,
+                                       args.threshold)
+        Logging.table(table)
+        if regressions:
+            Logging.subSection(f"{len(regressions)} stage(s) regressed", 1, "red")
+            exitCode = 1
+        else:
+            Logging.subSection("No regressions", 1, "green")
+    Logging.divider()
+    sys.exit(exitCode)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Checks that every variant --sweep renders is pixel-identical to rendering the same
+# values on their own. The banner sample is swept over base_font_height, which changes
+# the fonts and their strokes, and over padding, which doesn't. Exits with an error if
+# any variant differs from its standalone render.
+#
+#   python benchmarks/check_sweep.py
+#   python benchmarks/check_sweep.py --jobs 1
+
+import argparse
+import copy
+import itertools
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import toml
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "capper"))
+
+from pretty_logging import Logging
+
+SPEC = ROOT / "samples" / "banner" / "spec.toml"
+SWEEPS = {"base_font_height" : [20, 60], "padding" : [1.0, 1.5]}
+
+def writeSpec(spec, specFile):
+    with open(specFile, "w", encoding="utf-8") as f:
+        toml.dump(spec, f)
+    return specFile
+
+def render(specFile, *args):
+    subprocess.run([sys.executable, (ROOT / "capper" / "caption.py").as_posix(),
+                    specFile, *args], cwd=ROOT, check=True, stdout=subprocess.DEVNULL,
+                   env=dict(os.environ, CAPPER_DISK_CACHE="0"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Check --sweep variants against " \
+                                     "standalone renders")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Sweep worker processes. Defaults to the number of CPUs.")
+    args = parser.parse_args()
+
+    with open(SPEC, "r", encoding="utf-8") as f:
+        baseSpec = toml.load(f)
+    # base_font_height can't be given together with image_height
+    baseSpec["image"].pop("image_height", None)
+    baseSpec["output"]["outputs"] = ["caption"]
+    baseSpec["output"]["encode_preset"] = "fast"
+
+    Logging.header(f"Checking a sweep of {SWEEPS} against standalone renders")
+    table = [("Variant", "Sweep", "Standalone", "Result")]
+    failures = 0
+    with tempfile.TemporaryDirectory() as workDir:
+        sweepSpec = copy.deepcopy(baseSpec)
+        sweepSpec["text"].update(SWEEPS)
+        sweepSpec["output"]["output_directory"] = workDir
+        sweepSpec["output"]["base_filename"] = "sweep"
+        render(writeSpec(sweepSpec, f"{workDir}/sweep.toml"), "--sweep",
+               "--jobs", str(args.jobs))
+
+        for (i, values) in enumerate(itertools.product(*SWEEPS.values())):
+            spec = copy.deepcopy(baseSpec)
+            spec["text"].update(zip(SWEEPS.keys(), values))
+            spec["output"]["output_directory"] = workDir
+            spec["output"]["base_filename"] = f"alone_{i + 1:02}"
+            render(writeSpec(spec, f"{workDir}/alone_{i + 1:02}.toml"))
+
+            with Image.open(f"{workDir}/sweep_sweep_{i + 1:02}.png") as swept, \
+                 Image.open(f"{workDir}/alone_{i + 1:02}_cap.png") as alone:
+                same = swept.size == alone.size and swept.tobytes() == alone.tobytes()
+                failures += not same
+                table.append(("  ".join([f"{key}={value}" for (key, value)
+                                         in zip(SWEEPS, values)]),
+                              Logging.dimensionsStr(swept), Logging.dimensionsStr(alone),
+                              "identical" if same else "DIFFERENT"))
+    Logging.table(table)
+    if failures:
+        Logging.subSection(f"{failures} variant(s) differ from their standalone render",
+                           1, "red")
+    else:
+        Logging.subSection("Every variant matches its standalone render", 1, "green")
+    Logging.divider()
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
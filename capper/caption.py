@@ -1,380 +1,504 @@
 import argparse
 import colorama
+import cProfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import glob
 import time
-from math import ceil
+import multiprocessing
 import os
+from pathlib import Path
+import pstats
+import signal
 import subprocess
 import sys
-from PIL import Image, ImageDraw, ImageFont
+import tempfile
+import threading
+from PIL import Image
 
 from pretty_logging import Logging, UserError
+from profiling import Profiler, ProfileAggregate
+from render import Renderer, StripCaption
+from server import runServer
 from spec_parse import UserSpec
-from text import parseText, wrapRegions, TextBox
-
-class Font:
-    def __init__(self, path, height, color, stroke, strokeColor):
-        self.path = path
-        self.font = ImageFont.truetype(path, height)
-        self.height = height
-        self.spaceLen = self.font.getlength(" ")
-
-        fontColorMatches = UserSpec.rgbaRe.fullmatch(color)
-        self.color = color
-        self.rgba = (int(fontColorMatches[1], 16),
-                     int(fontColorMatches[2], 16),
-                     int(fontColorMatches[3], 16),
-                     int(fontColorMatches[4], 16))
-
-        self.stroke = stroke
-        strokeColorMatches = UserSpec.rgbaRe.fullmatch(strokeColor)
-        self.strokeRgba = (int(strokeColorMatches[1], 16),
-                           int(strokeColorMatches[2], 16),
-                           int(strokeColorMatches[3], 16),
-                           int(strokeColorMatches[4], 16))
-
-    def getLength(self, text):
-        return self.font.getlength(text)
-
-    def rescale(self, scale):
-        self.height = int(self.height * scale)
-        self.font = self.font.font_variant(size=self.height)
-
-    def imgDrawKwargs(self):
-        return {
-            "font" : self.font,
-            "fill" : self.rgba,
-            "stroke_width" : self.stroke,
-            "stroke_fill" : self.strokeRgba
-        }
-
-def loadFonts(charSpecs, baseHeight):
-    fonts = {}
-    for charSpec in charSpecs:
-        charFonts = {}
-        for font in ["font", "font_bold", "font_italic", "font_bolditalic"]:
-            height = max(1, int(baseHeight * charSpec["relative_height"]["value"]))
-            stroke = int(baseHeight * charSpec["stroke_width"]["value"])
-            charFonts[font] = Font(
-                charSpec[font]["value"], height, charSpec["color"]["value"],
-                stroke, charSpec["stroke_color"]["value"])
-        fonts[charSpec["name"]["value"]] = charFonts
-    return fonts
-
-def drawCredits(d, capCredits, creditsPos, artX, artY, artWidth, artHeight):
-    if capCredits == "":
-        return
+from sweep import runSweep
+from text import LineCache
 
-    if "credits" in FONTS:
-        font = FONTS["credits"]["font"]
-    else:
-        baseFont = FONTS[SPEC.characters[0]["name"]["value"]]["font"]
-        font = Font(baseFont.path, ceil(artHeight * 0.02), baseFont.color, 0, "#00000000")
-        FONTS["credits"] = {}
-        FONTS["credits"]["font"] = font
-        creditsChar = {}
-        creditsCharSpec = {
-            "name" : "credits",
-            "color" : baseFont.color,
-            "font" : baseFont.path,
-            "relative_height" : font.height/SPEC.text["base_font_height"]["value"]
-        }
-        UserSpec.checkKeys(creditsCharSpec,
-                           SPEC.characterValidKeys,
-                           SPEC.characterRequiredKeys,
-                           creditsChar)
-        SPEC.validateAndSetChar(creditsCharSpec, creditsChar)
-        SPEC.characters.append(creditsChar)
-
-    padding = font.height
-
-    fontKwargs = font.imgDrawKwargs()
-    fontKwargs.pop("fill")
-    fontKwargs.pop("stroke_fill")
-
-    (_, _, creditsWidth, creditsHeight) = \
-        d.multiline_textbbox((0, 0), capCredits, **fontKwargs)
-    # When creating a bounding box at (0, 0), PIL doesn't put the top left corner at
-    # exactly (0, 0). Manually correct this by adding an offset.
-    creditsWidth += 1
-    creditsHeight += 3
-    if creditsPos == "tl":
-        topLeft = (artX + padding, artY + padding)
-        d.multiline_text(topLeft, capCredits, align="left", **font.imgDrawKwargs())
-    elif creditsPos == "tr":
-        topLeft = (artX + artWidth - (creditsWidth + padding), artY + padding)
-        d.multiline_text(topLeft, capCredits, align="right", **font.imgDrawKwargs())
-    elif creditsPos == "bl":
-        topLeft = (artX + padding, artY + artHeight - (creditsHeight + padding))
-        d.multiline_text(topLeft, capCredits, align="left", **font.imgDrawKwargs())
-    elif creditsPos == "br":
-        topLeft = (artX + artWidth - (creditsWidth + padding),
-                   artY + artHeight - (creditsHeight + padding))
-        d.multiline_text(topLeft, capCredits, align="right", **font.imgDrawKwargs())
-
-def autoWidth(textHeight, fmtWords, textBoxPos):
-    charCount = 0
-    for word in fmtWords:
-        for unit in word.fmtUnits:
-            charCount += len(unit.txt)
-
-    # The "magic" equation below was found using data from two column captions.
-    # Thus, adjust the character count for non-split captions accorindgly.
-    if textBoxPos != TextBoxPos.SPLIT:
-        charCount /= 1.25
-
-    # These are "magic" numbers based off of data gathered from existing captions. As
-    # the character count of a caption increases, the number of characters per line
-    # tends to increase with the following linear curve.
-    optimalCharsPerLine = (0.00449057 * charCount) + 46.35
-
-    totalTextLen = 0
-    for word in fmtWords:
-        totalTextLen += word.actualLength
-    averageCharLenPx = totalTextLen/charCount
-    return optimalCharsPerLine * averageCharLenPx
-
-def autoRescale(textBoxes, art, imgHeight=None):
-    logStr = "Automatically rescaling text"
-    if art is not None:
-        logStr += " and art"
-    Logging.subSection(logStr)
-    textScaleHeight = max([textBox.height for textBox in textBoxes])
-
-    if imgHeight is None:
-        imgHeight = textScaleHeight if art is None else max(textScaleHeight, art.height)
-        imgHeight = min(imgHeight, 3000)
-
-    SPEC.text["base_font_height"]["value"] = int(
-        SPEC.text["base_font_height"]["value"] * (imgHeight/textScaleHeight))
-    fontTypes = ["font", "font_bold", "font_italic", "font_bolditalic"]
-    for person, configs in FONTS.items():
-        fonts = {fontName:font for (fontName, font) in configs.items()
-                 if fontName in fontTypes}
-        for font in fonts.values():
-            font.rescale(imgHeight/textScaleHeight)
-
-    # Must perform this rescale *after* fonts have been rescaled so that text lengths
-    # are recalculated properly.
-    for textBox in textBoxes:
-        textBox.rescale(imgHeight/textScaleHeight)
-
-    # After rescaling the text to be as close as possible to the target height, there
-    # may still large gaps above and below the text since PIL only allows for whole
-    # number font heights. If this is the case, scale the art down to fit to the text.
-    imgHeight = max([textBox.height for textBox in textBoxes])
-    SPEC.image["image_height"]["value"] = imgHeight
-
-    if art is None:
-        return None
-
-    artScale = imgHeight / art.height
-    resizedArt = art.resize((int(art.width * artScale), int(art.height * artScale)))
-    return resizedArt
-
-class TextBoxPos:
-    LEFT = "left"
-    RIGHT = "right"
-    SPLIT = "split"
-
-def generateCaption(textBoxes, textBoxPos, textAlignment, capCredits,
-                    creditsPos, art, fileName, bgColor):
-    if textBoxPos == TextBoxPos.SPLIT:
-        assert len(textBoxes) == 2
-        maxTextBoxWidth = max(textBoxes[0].width, textBoxes[1].width)
-        dimensions = (art.width + (maxTextBoxWidth * 2), art.height)
-    else:
-        assert len(textBoxes) == 1
-        textBox = textBoxes[0]
-        dimensions = (art.width + textBox.width, art.height)
-
-    fileFmt = SPEC.output["output_img_format"]["value"]
-    colorMode = "RGBA" if fileFmt == "png" else "RGB"
-    img = Image.new(colorMode, dimensions, bgColor)
-    d = ImageDraw.Draw(img)
-
-    if textBoxPos == TextBoxPos.LEFT:
-        img.paste(art, (textBox.width, 0))
-        textBox.drawText(d, textAlignment, startX=0,
-                         startY=int((art.height - textBox.height)/2))
-        drawCredits(d, capCredits, creditsPos, textBox.width, 0,
-                    art.width, art.height)
-
-    elif textBoxPos == TextBoxPos.RIGHT:
-        img.paste(art, (0, 0))
-        textBox.drawText(d, textAlignment, startX=art.width,
-                         startY=int((art.height - textBox.height)/2))
-        drawCredits(d, capCredits, creditsPos, 0, 0, art.width, art.height)
-
-    elif textBoxPos == TextBoxPos.SPLIT:
-        img.paste(art, (maxTextBoxWidth, 0))
-        textBoxes[0].drawText(d, textAlignment,
-                              startX=int((maxTextBoxWidth - textBoxes[0].width)/2),
-                              startY=int((art.height - textBoxes[0].height)/2))
-        textBoxes[1].drawText(d, textAlignment,
-                              startX=maxTextBoxWidth + art.width +
-                              int((maxTextBoxWidth - textBoxes[1].width)/2),
-                              startY=int((art.height - textBoxes[1].height)/2))
-        drawCredits(d, capCredits, creditsPos, maxTextBoxWidth, 0,
-                    art.width, art.height)
-
-    img.save(fileName, optimize=True, quality=SPEC.output["output_img_quality"]["value"])
-
-def generateOutputs(textBoxes, art):
-    Logging.header("Generating images")
-    fileSizeTable = []
+# Height that previews are scaled down to when no scale is given
+PREVIEW_HEIGHT = 1000
 
-    # Collect global values to use as arguments for generating files
-    textAlignment = SPEC.text["alignment"]["value"]
-    textBoxPos = SPEC.text["text_box_pos"]["value"]
-    capCredits = "\n".join(SPEC.text["credits"]["value"])
-    creditsPos = SPEC.text["credits_pos"]["value"]
+def openImage(imgFile):
+    imageViewerFromCommandLine = {'linux':'xdg-open',
+                                  'win32':'explorer',
+                                  'darwin':'open'}[sys.platform]
+    try:
+        subprocess.run([imageViewerFromCommandLine, os.path.abspath(imgFile)])
+    except OSError as e:
+        # The image was already written, so a missing viewer shouldn't fail the render
+        Logging.subSection(f"Couldn't open an image viewer ({e.strerror}), the image " \
+                           f"is at '{imgFile}'", 1, "yellow")
 
-    matches = SPEC.rgbaRe.fullmatch(SPEC.image["bg_color"]["value"])
-    bgColor = (int(matches[1], 16), int(matches[2], 16),
-               int(matches[3], 16), int(matches[4], 16))
+def generateOutputs(renderer, pages, art, openOnExit=False, specToStdout=False):
+    Logging.header("Generating images")
+    fileSizeTable = []
+    spec = renderer.spec
 
-    outputs = SPEC.output["outputs"]["value"]
-    imgQuality = SPEC.output["output_img_quality"]["value"]
-    baseFilename = SPEC.output["base_filename"]["value"]
-    directory = SPEC.output["output_directory"]["value"]
+    outputs = spec.output["outputs"]["value"]
+    baseFilename = spec.output["base_filename"]["value"]
+    directory = spec.output["output_directory"]["value"]
     if directory != "" and directory[-1] != "/" and directory[-1] != "\\":
         directory += "/"
-    outputFmt = SPEC.output["output_img_format"]["value"]
-
-    if "caption" in outputs:
-        capFile = directory + baseFilename + "_cap." + outputFmt
-        Logging.subSection(f"Generating caption '{capFile}'")
-        generateCaption(textBoxes, textBoxPos, textAlignment,
-                        capCredits, creditsPos, art, capFile, bgColor)
-        fileSizeTable.append((capFile,
-                              Logging.filesizeStr(capFile),
-                              Logging.dimensionsStr(capFile)))
-        if args.open_on_exit:
-            imageViewerFromCommandLine = {'linux':'xdg-open',
-                                          'win32':'explorer',
-                                          'darwin':'open'}[sys.platform]
-            subprocess.run([imageViewerFromCommandLine, os.path.abspath(capFile)])
-
-    colorMode = "RGBA" if outputFmt == "png" else "RGB"
-
-    if "text" in outputs:
-        for i, box in enumerate(textBoxes):
-            renderedTextFile = directory + baseFilename + f"_text{i}." + outputFmt
-            Logging.subSection(f"Generating text-only image '{renderedTextFile}'")
-            img = Image.new(colorMode, (box.width, box.height), bgColor)
-            box.drawText(ImageDraw.Draw(img), textAlignment)
-            img.save(renderedTextFile, optimize=True, quality=imgQuality)
-            fileSizeTable.append((renderedTextFile,
-                                  Logging.filesizeStr(renderedTextFile),
-                                  Logging.dimensionsStr(renderedTextFile)))
-
-    if "art" in outputs:
-        if SPEC.image["art"]["value"] is not None:
-            artFile = directory + baseFilename + "_art." + outputFmt
-            Logging.subSection(f"Generating rescaled art '{artFile}'")
-            img = Image.new(colorMode, (art.width, art.height), bgColor)
-            img.paste(art, (0, 0))
-            img.save(artFile, optimize=True, quality=imgQuality)
-            fileSizeTable.append((artFile,
-                                  Logging.filesizeStr(artFile),
-                                  Logging.dimensionsStr(artFile)))
-
-    if "credits" in outputs:
-        if capCredits != '' and SPEC.image["art"]["value"] is not None:
-            creditsFile = directory + baseFilename + "_credits." + outputFmt
-            Logging.subSection(f"Generating credits '{creditsFile}'")
-            img = Image.new(colorMode, (art.width, art.height), bgColor)
-            drawCredits(ImageDraw.Draw(img), capCredits, creditsPos, 0, 0,
-                        art.width, art.height)
-            img.save(creditsFile, optimize=True, quality=imgQuality)
-            fileSizeTable.append((creditsFile,
-                                  Logging.filesizeStr(creditsFile),
-                                  Logging.dimensionsStr(creditsFile)))
+    outputFmt = spec.output["output_img_format"]["value"]
+
+    (_, _, settings) = renderer.encodeSettings()
+    drawLock = threading.Lock()
+
+    def encodeGroup(pageSuffix, images):
+        # Draws the group if it hasn't been yet, then encodes it. Only the encoded
+        # data is kept, so at most one group per worker is in memory as pixels.
+        # FreeType faces are shared between pages, so pages are drawn one at a time.
+        if callable(images):
+            with drawLock:
+                images = images()
+        encoded = []
+        for (suffix, description, img) in images:
+            startTime = time.time()
+            if isinstance(img, StripCaption):
+                # Drawn while it's written, so it's written straight to its file
+                imgFile = directory + baseFilename + suffix + pageSuffix + "." + outputFmt
+                with drawLock, open(imgFile, "wb") as f:
+                    (size, imgSettings) = renderer.encodeStrips(img, f, f"Encoding {suffix}")
+                data = None
+            else:
+                with Profiler.stage(f"Encoding {suffix}"):
+                    data = renderer.encode(img)
+                (size, imgSettings) = (len(data), settings)
+            encoded.append((suffix + pageSuffix, description, Logging.dimensionsStr(img),
+                            data, size, imgSettings, time.time() - startTime))
+        return encoded
+
+    groups = renderer.outputGroups(pages, art, strips=True)
+    if not spec.text["paginate"]["value"]:
+        # A single page is drawn up front, so that the caption and text-only images
+        # share their text layers, and each image is then encoded on its own
+        groups = [(pageSuffix, [image]) for (pageSuffix, draw) in groups
+                  for image in draw()]
+    # Pillow's encoders release the GIL, so images are compressed at once. The
+    # encode phase takes about as long as the slowest image.
+    maxWorkers = max(1, min(len(groups), (os.cpu_count() or 1) + 4))
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        encoded = [output for outputs in executor.map(encodeGroup,
+                                                      [group[0] for group in groups],
+                                                      [group[1] for group in groups])
+                   for output in outputs]
+
+    for (suffix, description, dimensions, data, size, imgSettings, duration) in encoded:
+        imgFile = directory + baseFilename + suffix + "." + outputFmt
+        Logging.subSection(f"Generating {description} '{imgFile}'")
+        if data is not None:
+            with Profiler.stage("Writing outputs"), open(imgFile, "wb") as f:
+                f.write(data)
+        fileSizeTable.append((imgFile,
+                              Logging.sizeStr(size),
+                              dimensions,
+                              imgSettings,
+                              f"{duration:.2f}s"))
+        if suffix in ["_cap", "_cap_01"] and openOnExit:
+            openImage(imgFile)
 
     if "autospec" in outputs:
         specFilename = directory + baseFilename + "_autospec.toml"
         Logging.subSection(f"Generating filled-in specification '{specFilename}'")
-        SPEC.outputFilledSpec(specFilename)
-        fileSizeTable.append((specFilename, Logging.filesizeStr(specFilename), ""))
+        with Profiler.stage("Writing outputs"):
+            spec.outputFilledSpec(specFilename)
+        fileSizeTable.append((specFilename, Logging.filesizeStr(specFilename), "", "",
+                              ""))
 
     Logging.subSection("Successfully generated all images!", 1, "green")
-    Logging.table(fileSizeTable)
+    if fileSizeTable:
+        Logging.table(fileSizeTable)
 
-    if args.spec_to_stdout:
+    if specToStdout:
         Logging.header("Outputting autospec")
-        SPEC.outputFilledSpec()
-
-def main():
-    textInfoTable = []
-    baseFontHeight = SPEC.text["base_font_height"]["value"]
-
-    Logging.header(f"Reading and fitting text from '{SPEC.text['text']['value']}'")
-    with open(SPEC.text["text"]["value"], "r",encoding="utf-8") as f:
-        text = f.read()
-
-    firstChar = SPEC.characters[0]["name"]["value"]
-    fmtWords = parseText(text, FONTS, firstChar)
+        spec.outputFilledSpec()
+
+    return fileSizeTable
+
+def generatePreview(renderer, pages, art, scale=None, specToStdout=False):
+    # Draws every page of the caption at a fraction of its size with the fastest
+    # encoder and opens the first one. Nothing else in the specification is written.
+    Logging.header("Generating preview")
+    spec = renderer.spec
+    UserError.uassert(art is not None, "Previewing a caption requires 'art' under [image]")
+    if scale is None:
+        scale = min(1.0, PREVIEW_HEIGHT / art.height)
+    fullWidth = art.width + len(pages[0]) * max([textBox.width for textBox in pages[0]])
+    fullDimensions = f"{fullWidth}x{art.height} px"
+    (previewRenderer, pages, art) = renderer.preview(pages, art, scale)
+
+    baseFilename = spec.output["base_filename"]["value"]
+    directory = spec.output["output_directory"]["value"]
+    if directory != "" and directory[-1] != "/" and directory[-1] != "\\":
+        directory += "/"
+    outputFmt = spec.output["output_img_format"]["value"]
+    (_, _, settings) = renderer.encodeSettings("fast")
 
-    textInfoTable.append(
-        ("Word Count", sum([1 for word in fmtWords if word.fmtUnits != []])))
+    fileSizeTable = []
+    for (i, textBoxes) in enumerate(pages):
+        suffix = f"_preview_{i + 1:02}" if spec.text["paginate"]["value"] else "_preview"
+        imgFile = directory + baseFilename + suffix + "." + outputFmt
+        Logging.subSection(f"Generating preview '{imgFile}'")
+        startTime = time.time()
+        img = previewRenderer.drawCaption(textBoxes, art)
+        with Profiler.stage(f"Encoding {suffix}"):
+            data = renderer.encode(img, "fast")
+        with Profiler.stage("Writing outputs"), open(imgFile, "wb") as f:
+            f.write(data)
+        fileSizeTable.append((imgFile, Logging.sizeStr(len(data)),
+                              Logging.dimensionsStr(img), settings,
+                              f"{time.time() - startTime:.2f}s"))
+        if i == 0:
+            openImage(imgFile)
+
+    Logging.subSection(f"Previewed at {scale:.0%} scale (full size is {fullDimensions})",
+                       1, "green")
+    Logging.table(fileSizeTable)
 
-    textBoxPos = SPEC.text["text_box_pos"]["value"]
-    if SPEC.text["text_width"]["default"]:
-        baseTextWidth = autoWidth(baseFontHeight, fmtWords, textBoxPos)
-        SPEC.text["text_width"]["value"] = round(baseTextWidth / baseFontHeight, 2)
-    else:
-        baseTextWidth = SPEC.text["text_width"]["value"] * baseFontHeight
-    wrappedText = wrapRegions(fmtWords, baseTextWidth)
-    textBoxes = [TextBox(wrappedText, baseFontHeight,
-                 SPEC.text["line_spacing"]["value"] * baseFontHeight,
-                 SPEC.text["padding"]["value"] * baseFontHeight)]
-
-    artFilename = SPEC.image["art"]["value"]
-    art = Image.open(artFilename) if artFilename is not None else None
-
-    if textBoxPos == TextBoxPos.SPLIT:
-        textBoxes = textBoxes[0].split()
-        textInfoTable.append(("Line Count (left)", len(textBoxes[0].fmtLines)))
-        textInfoTable.append(("Line Count (right)", len(textBoxes[1].fmtLines)))
+    if specToStdout:
+        Logging.header("Outputting autospec")
+        spec.outputFilledSpec()
+
+    return fileSizeTable
+
+def main(renderer, openOnExit=False, specToStdout=False, preview=False,
+         previewScale=None):
+    (pages, art) = renderer.layoutPages()
+    if preview:
+        return generatePreview(renderer, pages, art, previewScale, specToStdout)
+    return generateOutputs(renderer, pages, art, openOnExit, specToStdout)
+
+def loadSpec(specFile):
+    with Profiler.stage("Spec validation"):
+        return UserSpec(specFile)
+
+def renderSpec(specFile, openOnExit=False, specToStdout=False, preview=False,
+               previewScale=None):
+    return main(Renderer(loadSpec(specFile)), openOnExit, specToStdout, preview,
+                previewScale)
+
+def reportProfile(profile, profileJson, aggregate=None, lineStats=None):
+    lineStats = LineCache.stats() if lineStats is None else lineStats
+    if profileJson is not None:
+        if aggregate is None:
+            Profiler.toJson(profileJson, caches={"lines" : lineStats})
+        else:
+            aggregate.toJson(profileJson, caches={"lines" : lineStats})
+    if not profile:
+        return
+    if aggregate is None:
+        Logging.header("Stage timings")
+        Logging.table(Profiler.table())
     else:
-        textInfoTable.append(("Line Count", len(textBoxes[0].fmtLines)))
-
-    if not SPEC.text["base_font_height"]["default"]:
-        baseImgHeight = max([textBox.height for textBox in textBoxes])
-    elif not SPEC.image["image_height"]["default"]:
-        baseImgHeight = SPEC.image["image_height"]["value"]
+        Logging.header(f"Stage timings across {aggregate.renders} specification files")
+        Logging.table(aggregate.table())
+    Logging.table(LineCache.statsTable(lineStats))
+
+def watchedFiles(specFile, spec):
+    files = [specFile]
+    if spec is not None:
+        files.append(spec.text["text"]["value"])
+        if spec.image["art"]["value"] is not None:
+            files.append(spec.image["art"]["value"])
+    return files
+
+def fileMtimes(files):
+    mtimes = {}
+    for fileName in files:
+        mtimes[fileName] = os.stat(fileName).st_mtime_ns if Path(fileName).is_file() \
+                           else None
+    return mtimes
+
+def runWatch(specFile, interval, openOnExit=False, specToStdout=False, profile=False,
+             profileJson=None, preview=False, previewScale=None):
+    (renderer, artCache) = (None, {})
+    changed = [specFile]
+
+    while True:
+        baseSpec = None if renderer is None else renderer.baseSpec
+        mtimes = fileMtimes(watchedFiles(specFile, baseSpec))
+        startTime = time.time()
+        Profiler.clear()
+        LineCache.resetStats()
+        try:
+            if specFile in changed or renderer is None:
+                # Fonts and parsed paragraphs are only thrown away when the
+                # specification itself changes
+                renderer = None
+                renderer = Renderer(loadSpec(specFile), artCache=artCache)
+                mtimes = fileMtimes(watchedFiles(specFile, renderer.baseSpec))
+
+            main(renderer, openOnExit, specToStdout, preview, previewScale)
+            Logging.subSection(f"Re-parsed {renderer.paragraphs.reparsed} paragraph(s)")
+            reportProfile(profile, profileJson)
+            Logging.header(f"Rendered in {time.time()-startTime:.2f} seconds")
+        except UserError as e:
+            Logging.divider()
+            print(f"\nUserError: {e.message}")
+        except Exception as e:
+            # Editors that don't save atomically leave half-written art or text
+            # behind for a moment, so report it and keep watching for the next save
+            Logging.divider()
+            print(f"\n{type(e).__name__}: {e}")
+
+        Logging.header(f"Watching {', '.join(mtimes.keys())} for changes " \
+                       "(Ctrl+C to stop)")
+        Logging.divider()
+        while True:
+            time.sleep(interval)
+            newMtimes = fileMtimes(mtimes.keys())
+            changed = [f for f in mtimes if newMtimes[f] != mtimes[f]]
+            if changed:
+                break
+
+# Decoded art, kept for the lifetime of a server worker process
+SERVE_ART_CACHE = {}
+
+def initServeWorker():
+    # Ctrl+C is handled by the server process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Logging.quiet = True
+
+def serveWorker(specData, text):
+    try:
+        renderer = Renderer(specData, text, SERVE_ART_CACHE)
+        UserError.uassert(renderer.baseSpec.image["art"]["value"] is not None,
+                          "Rendering a caption requires 'art' under [image]")
+        # Paginated specifications preview their first page
+        (pages, art) = renderer.layoutPages()
+        img = renderer.drawCaption(pages[0], art)
+    except UserError as e:
+        return (400, "text/plain; charset=utf-8", e.message.encode("utf-8"))
+
+    (pilFormat, _, _) = renderer.encodeSettings()
+    # Previews favor latency over file size, so unless the specification picks a
+    # preset, use the fastest one
+    preset = "fast" if renderer.spec.output["encode_preset"]["default"] else None
+    return (200, Image.MIME.get(pilFormat, "application/octet-stream"),
+            renderer.encode(img, preset))
+
+def collectBatchSpecs(batchPath):
+    if Path(batchPath).is_dir():
+        specFiles = [f.as_posix() for f in sorted(Path(batchPath).glob("*.toml"))]
     else:
-        baseImgHeight = None
-    art = autoRescale(textBoxes, art, baseImgHeight)
-
-    Logging.subSection("Successfully manipulated text!", 1, "green")
-    Logging.table(textInfoTable)
-    generateOutputs(textBoxes, art)
+        specFiles = sorted(glob.glob(batchPath))
+    UserError.uassert(specFiles != [],
+                      f"No specification files found matching '{batchPath}'")
+    return specFiles
+
+def initBatchWorker():
+    Logging.quiet = True
+
+def batchWorker(specFile, useCProfile=False):
+    # Returns (spec file, outputs, duration, error, stage timings, line cache
+    # statistics, pstats file), where the error is (exception type, message). Each
+    # worker keeps its rasterized lines for the next specification it renders.
+    startTime = time.time()
+    Profiler.clear()
+    LineCache.resetStats()
+    profiler = cProfile.Profile() if useCProfile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        outputs = [row[0] for row in renderSpec(specFile)]
+        error = None
+    except UserError as e:
+        (outputs, error) = ([], ("UserError", e.message))
+    except Exception as e:
+        # Anything else (e.g. invalid TOML) would otherwise take down the whole pool
+        (outputs, error) = ([], (type(e).__name__, str(e)))
+    duration = time.time() - startTime
+
+    statsFile = None
+    if profiler is not None:
+        profiler.disable()
+        (fd, statsFile) = tempfile.mkstemp(suffix=".pstats")
+        os.close(fd)
+        profiler.dump_stats(statsFile)
+    return (specFile, outputs, duration, error, Profiler.snapshot(), LineCache.stats(),
+            statsFile)
+
+def runBatch(batchPath, jobs, profile=False, profileJson=None, cprofileFile=None):
+    specFiles = collectBatchSpecs(batchPath)
+    Logging.header(f"Rendering {len(specFiles)} specification files with " \
+                   f"{jobs} worker(s)")
+
+    results = {}
+    aggregate = ProfileAggregate()
+    lineStats = LineCache.stats()
+    statsFiles = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initBatchWorker) as executor:
+        futures = [executor.submit(batchWorker, specFile, cprofileFile is not None)
+                   for specFile in specFiles]
+        for future in as_completed(futures):
+            (specFile, outputs, duration, error, stages, workerLineStats,
+             statsFile) = future.result()
+            results[specFile] = (outputs, duration, error)
+            aggregate.add(stages)
+            lineStats = LineCache.combineStats(lineStats, workerLineStats)
+            if statsFile is not None:
+                statsFiles.append(statsFile)
+            if error is None:
+                Logging.subSection(f"Rendered '{specFile}' in {duration:.2f}s")
+            else:
+                Logging.subSection(f"Failed to render '{specFile}'", 1, "red")
+
+    batchTable = [("Specification", "Outputs", "Time", "Status")]
+    failures = []
+    for specFile in specFiles:
+        (outputs, duration, error) = results[specFile]
+        status = "ok" if error is None else "FAILED"
+        batchTable.append((specFile, len(outputs), f"{duration:.2f}s", status))
+        for output in outputs:
+            batchTable.append((f"  {output}", "", "", ""))
+        if error is not None:
+            failures.append((specFile, error))
+
+    Logging.header("Batch summary")
+    Logging.table(batchTable)
+    for (specFile, (errorType, message)) in failures:
+        Logging.subSection(f"{errorType} in '{specFile}': {message}", 1, "red")
+    color = "green" if not failures else "red"
+    Logging.subSection(f"{len(specFiles) - len(failures)} of {len(specFiles)} " \
+                       "specification files rendered successfully", 1, color)
+
+    reportProfile(profile, profileJson, aggregate, lineStats)
+    if statsFiles:
+        # Every worker profiles its own renders, so merge them into one file
+        stats = pstats.Stats(*statsFiles)
+        stats.dump_stats(cprofileFile)
+        for statsFile in statsFiles:
+            os.remove(statsFile)
+        Logging.subSection(f"Wrote merged cProfile statistics to '{cprofileFile}'")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     parser = argparse.ArgumentParser(
         prog="CaptionGenerator",
         description="Generate a caption given a vaild .toml specification file",
         epilog="Have fun writing!")
-    parser.add_argument("specification_file", help="The specification for your " \
-                        "caption. See the GitHub page for a guide on how it must " \
-                        "be formatted.")
+    parser.add_argument("specification_file", nargs="?", help="The specification " \
+                        "for your caption. See the GitHub page for a guide on how " \
+                        "it must be formatted.")
     parser.add_argument("-o", "--open_on_exit", action="store_true", help="If a " \
                         "caption is generated, open it with your default image " \
                         "viewer.")
     parser.add_argument("-s", "--spec_to_stdout", action="store_true", help="Output " \
                         "the complete specification, with all automatically filled " \
                         "values, to the terminal.")
+    parser.add_argument("-b", "--batch", metavar="PATH", help="Render every " \
+                        "specification file in a directory, or every file matching " \
+                        "a glob pattern, in one process pool.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number " \
+                        "of worker processes to use with --batch, --serve, or --sweep. " \
+                        "Defaults to the number of CPUs.")
+    parser.add_argument("-w", "--watch", action="store_true", help="Stay open and " \
+                        "render the caption again whenever the specification, text, " \
+                        "or art changes.")
+    parser.add_argument("--watch_interval", type=float, default=0.5, metavar="SECONDS",
+                        help="How often --watch checks for changes. Defaults to 0.5.")
+    parser.add_argument("--sweep", action="store_true", help="Render every " \
+                        "combination of the values listed for base_font_height, " \
+                        "padding, line_spacing, or text_width under [text], plus a " \
+                        "contact sheet of all of them.")
+    parser.add_argument("-p", "--preview", action="store_true", help="Lay the " \
+                        "caption out exactly, but draw it at a reduced scale with the " \
+                        "fastest encoder and open it. Only the preview is written.")
+    parser.add_argument("--preview_scale", type=float, metavar="SCALE", help="Scale " \
+                        "--preview draws at, e.g. 0.5. Defaults to fitting the caption " \
+                        f"in {PREVIEW_HEIGHT} px of height.")
+    parser.add_argument("--serve", action="store_true", help="Run a local HTTP " \
+                        "server that renders captions posted to /render and reports " \
+                        "statistics at /stats.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address --serve binds " \
+                        "to. Defaults to 127.0.0.1.")
+    parser.add_argument("--port", type=int, default=8000, help="Port --serve " \
+                        "listens on. Defaults to 8000.")
+    parser.add_argument("--profile", action="store_true", help="Print the wall and " \
+                        "CPU time spent in each stage of rendering. With --batch, " \
+                        "the timings of every specification are added together.")
+    parser.add_argument("--profile_json", metavar="FILE", help="Also write the stage " \
+                        "timings to a JSON file.")
+    parser.add_argument("--cprofile", metavar="FILE", help="Run under cProfile and " \
+                        "write the statistics to a file readable by pstats.")
+    parser.add_argument("--no_disk_cache", action="store_true", help="Don't read or " \
+                        "write the font index and text measurements cached between " \
+                        "runs.")
     args = parser.parse_args()
+    if args.serve:
+        if args.specification_file is not None or args.batch is not None or args.watch:
+            parser.error("--serve cannot be combined with a specification file, " \
+                         "--batch, or --watch")
+    elif args.batch is None and args.specification_file is None:
+        parser.error("either a specification file, --batch, or --serve is required")
+    if args.batch is not None and args.specification_file is not None:
+        parser.error("cannot give a specification file together with --batch")
+    if args.batch is not None and (args.open_on_exit or args.spec_to_stdout):
+        parser.error("--batch cannot be combined with -o or -s")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.watch and args.batch is not None:
+        parser.error("--watch cannot be combined with --batch")
+    if args.sweep and (args.batch is not None or args.watch or args.serve or
+                       args.spec_to_stdout):
+        parser.error("--sweep cannot be combined with --batch, --watch, --serve, or -s")
+    if args.preview and (args.batch is not None or args.serve or args.sweep):
+        parser.error("--preview cannot be combined with --batch, --serve, or --sweep")
+    if args.preview_scale is not None and not args.preview:
+        parser.error("--preview_scale requires --preview")
+    if args.preview_scale is not None and not 0 < args.preview_scale <= 1:
+        parser.error("--preview_scale must be greater than 0 and at most 1")
+    if args.serve and (args.profile or args.profile_json or args.cprofile):
+        parser.error("--serve cannot be combined with --profile, --profile_json, or " \
+                     "--cprofile; see /stats instead")
+
+    if args.no_disk_cache:
+        # Set in the environment so that batch and server workers see it too
+        os.environ["CAPPER_DISK_CACHE"] = "0"
 
     colorama.init()
     START_TIME = time.time()
+    # Batch workers profile themselves, and the results are merged by `runBatch()`
+    profiler = cProfile.Profile() if args.cprofile and args.batch is None else None
+    if profiler is not None:
+        profiler.enable()
     try:
-        SPEC = UserSpec(args.specification_file)
-        FONTS = loadFonts(SPEC.characters, SPEC.text["base_font_height"]["value"])
-        main()
+        if args.serve:
+            runServer(args.host, args.port, args.jobs, serveWorker, initServeWorker)
+        elif args.batch is not None:
+            runBatch(args.batch, args.jobs, args.profile, args.profile_json,
+                     args.cprofile)
+        elif args.sweep:
+            (sheetFile, lineStats) = runSweep(args.specification_file, args.jobs)
+            if args.open_on_exit:
+                openImage(sheetFile)
+            reportProfile(args.profile, args.profile_json, lineStats=lineStats)
+        elif args.watch:
+            runWatch(args.specification_file, args.watch_interval,
+                     args.open_on_exit, args.spec_to_stdout, args.profile,
+                     args.profile_json, args.preview, args.preview_scale)
+        else:
+            renderSpec(args.specification_file, args.open_on_exit, args.spec_to_stdout,
+                       args.preview, args.preview_scale)
+            reportProfile(args.profile, args.profile_json)
         Logging.header(f"Program finished in {time.time()-START_TIME:.2f} seconds")
         Logging.divider()
     except UserError as e:
         Logging.divider()
         print(f"\nUserError: {e.message}")
+    except KeyboardInterrupt:
+        if not (args.watch or args.serve):
+            raise
+        print()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
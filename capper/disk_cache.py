@@ -0,0 +1,46 @@
+import json
+import os
+from pathlib import Path
+import tempfile
+
+# Per-user files that outlive a single run, such as the font index and measured text
+# lengths. They're only an optimization, so unreadable or unwritable files are
+# ignored. CAPPER_CACHE_DIR moves them and CAPPER_DISK_CACHE=0 turns them off.
+class DiskCache:
+    @staticmethod
+    def enabled():
+        return os.environ.get("CAPPER_DISK_CACHE", "1") != "0"
+
+    @staticmethod
+    def directory():
+        if "CAPPER_CACHE_DIR" in os.environ:
+            return Path(os.environ["CAPPER_CACHE_DIR"])
+        if os.name == "nt" and "LOCALAPPDATA" in os.environ:
+            return Path(os.environ["LOCALAPPDATA"]) / "capper"
+        return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "capper"
+
+    @staticmethod
+    def read(name):
+        if not DiskCache.enabled():
+            return None
+        try:
+            with open(DiskCache.directory() / name, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def write(name, data):
+        # Writes to a temporary file first so that concurrent runs (e.g. batch workers)
+        # never read a half written file
+        if not DiskCache.enabled():
+            return
+        fileName = DiskCache.directory() / name
+        try:
+            fileName.parent.mkdir(parents=True, exist_ok=True)
+            (fd, tmpName) = tempfile.mkstemp(dir=fileName.parent, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmpName, fileName)
+        except OSError:
+            pass
@@ -0,0 +1,193 @@
+from bisect import bisect_right
+import os
+from pathlib import Path
+import struct
+import threading
+
+from disk_cache import DiskCache
+from pretty_logging import Logging
+from profiling import Profiler
+
+FONT_SUFFIXES = [".ttf", ".otf", ".ttc", ".otc"]
+
+def cmapCoverage(fileName):
+    # Code points the font has glyphs for as [[first, last], ...], read straight from
+    # its 'cmap' table. Only the table directory and the table itself are read.
+    # Returns None if the file isn't a font this understands.
+    try:
+        with open(fileName, "rb") as f:
+            def read(offset, size):
+                f.seek(offset)
+                data = f.read(size)
+                if len(data) != size:
+                    raise ValueError("Unexpected end of font file")
+                return data
+
+            # Collections start with a header pointing at each font; use the first
+            fontOffset = 0
+            if read(0, 4) == b"ttcf":
+                fontOffset = struct.unpack(">I", read(12, 4))[0]
+            numTables = struct.unpack(">H", read(fontOffset + 4, 2))[0]
+            tables = read(fontOffset + 12, 16 * numTables)
+            for i in range(numTables):
+                (tag, _, tableOffset, tableLength) = struct.unpack_from(">4sIII", tables, 16 * i)
+                if tag == b"cmap":
+                    break
+            else:
+                return None
+            cmap = read(tableOffset, tableLength)
+    except (OSError, ValueError, struct.error):
+        return None
+
+    try:
+        # Prefer the full Unicode subtable (format 12) over the BMP one (format 4)
+        subtables = {}
+        for i in range(struct.unpack_from(">H", cmap, 2)[0]):
+            (platform, encoding, offset) = struct.unpack_from(">HHI", cmap, 4 + 8 * i)
+            if platform == 0 or (platform == 3 and encoding in [1, 10]):
+                subtables.setdefault(struct.unpack_from(">H", cmap, offset)[0], offset)
+
+        ranges = []
+        if 12 in subtables:
+            offset = subtables[12]
+            numGroups = struct.unpack_from(">I", cmap, offset + 12)[0]
+            for i in range(numGroups):
+                (first, last, _) = struct.unpack_from(">III", cmap, offset + 16 + 12 * i)
+                ranges.append([first, last])
+        elif 4 in subtables:
+            offset = subtables[4]
+            segCount = struct.unpack_from(">H", cmap, offset + 6)[0] // 2
+            ends = struct.unpack_from(f">{segCount}H", cmap, offset + 14)
+            starts = struct.unpack_from(f">{segCount}H", cmap, offset + 16 + 2 * segCount)
+            rangeOffsetsStart = offset + 16 + 6 * segCount
+            rangeOffsets = struct.unpack_from(f">{segCount}H", cmap, rangeOffsetsStart)
+            for (i, (first, last)) in enumerate(zip(starts, ends)):
+                if first == 0xFFFF:
+                    continue
+                if rangeOffsets[i] == 0:
+                    ranges.append([first, last])
+                    continue
+                # Code points in this segment index into the glyph array, where glyph 0
+                # means the font has no glyph for it
+                for codePoint in range(first, last + 1):
+                    glyphOffset = (rangeOffsetsStart + 2 * i + rangeOffsets[i] +
+                                   2 * (codePoint - first))
+                    if struct.unpack_from(">H", cmap, glyphOffset)[0] != 0:
+                        ranges.append([codePoint, codePoint])
+        else:
+            return None
+    except struct.error:
+        return None
+
+    merged = []
+    for (first, last) in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+# Every font under a directory, indexed by family and variant (e.g. "NotoSerif" and
+# "-bold.ttf" for "NotoSerif-Bold.ttf") along with each font's cmap coverage. Indexes
+# are kept in the disk cache, keyed by directory, and rebuilt when the modification
+# time of any directory in the tree changes (i.e. when a font is added, removed, or
+# renamed).
+class FontIndex:
+    indexes = {}
+    coverageStarts = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def splitName(fileName):
+        # "NotoSerif-BoldItalic.ttf" -> ("NotoSerif", "-bolditalic.ttf")
+        path = Path(fileName)
+        (family, dash, variant) = path.stem.rpartition("-")
+        if not dash:
+            return (path.stem, path.suffix.lower())
+        return (family, f"-{variant}{path.suffix}".lower())
+
+    @staticmethod
+    def isCurrent(index):
+        for (directory, mtime) in index["dirs"].items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    @staticmethod
+    def build(root):
+        with Profiler.stage("Font indexing"):
+            index = {"dirs" : {}, "families" : {}, "variants" : {}, "coverage" : {}}
+            for (directory, dirNames, fileNames) in os.walk(root):
+                dirNames.sort()
+                index["dirs"][directory] = os.stat(directory).st_mtime_ns
+                for fileName in sorted(fileNames):
+                    if Path(fileName).suffix.lower() not in FONT_SUFFIXES:
+                        continue
+                    relPath = Path(directory, fileName).relative_to(root).as_posix()
+                    (family, variant) = FontIndex.splitName(fileName)
+                    index["families"].setdefault(family, {}).setdefault(variant, relPath)
+                    index["variants"].setdefault(variant, relPath)
+                    index["coverage"][relPath] = cmapCoverage(Path(directory, fileName))
+        Logging.subSection(f"Indexed {len(index['coverage'])} fonts in '{root}'", 3)
+        return index
+
+    @staticmethod
+    def get(directory):
+        # Returns the index of the directory, or None if it doesn't exist
+        root = os.path.abspath(directory)
+        if not os.path.isdir(root):
+            return None
+
+        with FontIndex.lock:
+            if root not in FontIndex.indexes:
+                FontIndex.indexes.update(DiskCache.read("font_index.json") or {})
+            index = FontIndex.indexes.get(root)
+            if index is not None and FontIndex.isCurrent(index):
+                return index
+
+            index = FontIndex.build(root)
+            FontIndex.indexes[root] = index
+            FontIndex.coverageStarts = {}
+            DiskCache.write("font_index.json", FontIndex.indexes)
+            return index
+
+    @staticmethod
+    def findVariant(fontFile, variant):
+        # Path of the `variant` (e.g. "-Bold.ttf") of the family of `fontFile`, or of
+        # any font under the same directory with that suffix if the family doesn't have
+        # one. Falls back to `fontFile` itself.
+        parentDir = Path(fontFile).parent
+        index = FontIndex.get(parentDir)
+        if index is None:
+            return fontFile
+        (family, _) = FontIndex.splitName(fontFile)
+        relPath = index["families"].get(family, {}).get(variant.lower(),
+                  index["variants"].get(variant.lower()))
+        return fontFile if relPath is None else (parentDir / relPath).as_posix()
+
+    @staticmethod
+    def missingChars(fontFile, chars):
+        # The characters the font has no glyphs for. Fonts whose coverage is unknown
+        # are assumed to have every glyph.
+        index = FontIndex.get(Path(fontFile).parent)
+        if index is None:
+            return set()
+        root = os.path.abspath(Path(fontFile).parent)
+        relPath = Path(fontFile).name
+        coverage = index["coverage"].get(relPath)
+        if coverage is None:
+            return set()
+
+        key = (root, relPath)
+        if key not in FontIndex.coverageStarts:
+            FontIndex.coverageStarts[key] = [first for (first, _) in coverage]
+        starts = FontIndex.coverageStarts[key]
+        missing = set()
+        for char in chars:
+            i = bisect_right(starts, ord(char)) - 1
+            if i < 0 or coverage[i][1] < ord(char):
+                missing.add(char)
+        return missing
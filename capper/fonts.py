@@ -0,0 +1,263 @@
+from collections import OrderedDict
+import copy
+import hashlib
+from pathlib import Path
+import PIL
+from PIL import ImageFont
+import threading
+
+from disk_cache import DiskCache
+from profiling import Profiler
+from spec_parse import UserSpec
+
+# Process-wide, bounded LRU cache of FreeType faces keyed on (path, height). Faces are
+# never mutated after creation, so every `Font` using the same file at the same size
+# shares one face regardless of its color or stroke. In batch mode, faces stay loaded
+# across every specification a worker renders. Fitting text and previews try many
+# sizes, so the least recently used faces are dropped to keep long-running processes
+# (e.g. --serve) from growing without bound.
+class FaceCache:
+    maxSize = 64
+    faces = OrderedDict()
+    loads = 0
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(path, height):
+        key = (path, height)
+        with FaceCache.lock:
+            face = FaceCache.faces.get(key)
+            if face is not None:
+                FaceCache.faces.move_to_end(key)
+                return face
+
+            with Profiler.stage("Font loading"):
+                face = ImageFont.truetype(path, height)
+            FaceCache.loads += 1
+            FaceCache.faces[key] = face
+            if len(FaceCache.faces) > FaceCache.maxSize:
+                FaceCache.faces.popitem(last=False)
+            return face
+
+    @staticmethod
+    def clear():
+        with FaceCache.lock:
+            FaceCache.faces = OrderedDict()
+
+# Text lengths measured by earlier runs, kept per font in the disk cache. Files are
+# named after a hash of the font's contents (and of what measured it), so renamed
+# fonts keep their lengths and edited ones are measured again. With a warm cache,
+# laying text out never loads a FreeType face; faces are only needed to draw.
+class MetricsCache:
+    maxSize = 1 << 17
+    # Font path -> (cache file name, {text : length per pixel of font height})
+    fonts = {}
+    dirty = set()
+    lock = threading.Lock()
+
+    @staticmethod
+    def fileName(path):
+        digest = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        except OSError:
+            return None
+        digest.update(f"{MeasureCache.referenceHeight} {PIL.__version__} " \
+                      f"{ImageFont.core.freetype2_version}".encode())
+        return f"metrics/{digest.hexdigest()[:32]}.json"
+
+    @staticmethod
+    def get(path):
+        # Returns the lengths of the font, or None if the disk cache is off
+        if not DiskCache.enabled():
+            return None
+        with MetricsCache.lock:
+            if path not in MetricsCache.fonts:
+                fileName = MetricsCache.fileName(path)
+                lengths = None if fileName is None else DiskCache.read(fileName)
+                MetricsCache.fonts[path] = (fileName,
+                                            lengths if isinstance(lengths, dict) else {})
+            return MetricsCache.fonts[path][1]
+
+    @staticmethod
+    def add(path, text, units):
+        lengths = MetricsCache.get(path)
+        if lengths is None or len(lengths) >= MetricsCache.maxSize:
+            return
+        with MetricsCache.lock:
+            lengths[text] = units
+            MetricsCache.dirty.add(path)
+
+    @staticmethod
+    def save():
+        # Writes the fonts that were measured since they were last saved
+        with MetricsCache.lock:
+            saved = [(MetricsCache.fonts[path][0], dict(MetricsCache.fonts[path][1]))
+                     for path in MetricsCache.dirty if MetricsCache.fonts[path][0]]
+            MetricsCache.dirty = set()
+        for (fileName, lengths) in saved:
+            DiskCache.write(fileName, lengths)
+
+    @staticmethod
+    def clear():
+        with MetricsCache.lock:
+            MetricsCache.fonts = {}
+            MetricsCache.dirty = set()
+
+# Bounded LRU cache of text lengths keyed on (path, text). Lengths are stored per
+# pixel of font height, measured once at a large reference height where hinting's
+# rounding of advances is negligible, so the length at any size is a multiply. Layout
+# and rescaling only ever use these; text is measured exactly at its final size by
+# `Font.getLength()` just before drawing. Misses fall back to `MetricsCache` before
+# measuring with FreeType.
+class MeasureCache:
+    maxSize = 1 << 16
+    referenceHeight = 2048
+    lengths = OrderedDict()
+    # Font path -> [hits, disk hits, misses]
+    stats = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def getUnits(path, text):
+        key = (path, text)
+        with MeasureCache.lock:
+            counters = MeasureCache.stats.setdefault(path, [0, 0, 0])
+            units = MeasureCache.lengths.get(key)
+            if units is not None:
+                MeasureCache.lengths.move_to_end(key)
+                counters[0] += 1
+                return units
+
+        diskLengths = MetricsCache.get(path)
+        units = None if diskLengths is None else diskLengths.get(text)
+        fromDisk = units is not None
+        if not fromDisk:
+            face = FaceCache.get(path, MeasureCache.referenceHeight)
+            units = face.getlength(text) / MeasureCache.referenceHeight
+            MetricsCache.add(path, text, units)
+        with MeasureCache.lock:
+            counters[1 if fromDisk else 2] += 1
+            MeasureCache.lengths[key] = units
+            if len(MeasureCache.lengths) > MeasureCache.maxSize:
+                MeasureCache.lengths.popitem(last=False)
+        return units
+
+    @staticmethod
+    def statsTable():
+        table = [("Font", "Measure Hits", "Disk Hits", "Misses", "Hit Rate")]
+        for (path, (hits, diskHits, misses)) in MeasureCache.stats.items():
+            table.append((Path(path).name, hits, diskHits, misses,
+                          f"{100 * (hits + diskHits) / (hits + diskHits + misses):.1f}%"))
+        return table
+
+    @staticmethod
+    def resetStats():
+        # Counts lookups from here on. Measured lengths are kept.
+        with MeasureCache.lock:
+            MeasureCache.stats = {}
+
+    @staticmethod
+    def clear():
+        with MeasureCache.lock:
+            MeasureCache.lengths = OrderedDict()
+            MeasureCache.stats = {}
+        MetricsCache.clear()
+
+class Font:
+    def __init__(self, path, height, color, stroke, strokeColor):
+        self.path = path
+        self.height = height
+        # Loaded on first use so that variants the text never touches (e.g. an
+        # autoselected bold-italic face) are never parsed.
+        self._face = None
+        self._spaceUnits = None
+
+        fontColorMatches = UserSpec.rgbaRe.fullmatch(color)
+        self.color = color
+        self.rgba = (int(fontColorMatches[1], 16),
+                     int(fontColorMatches[2], 16),
+                     int(fontColorMatches[3], 16),
+                     int(fontColorMatches[4], 16))
+
+        self.stroke = stroke
+        strokeColorMatches = UserSpec.rgbaRe.fullmatch(strokeColor)
+        self.strokeRgba = (int(strokeColorMatches[1], 16),
+                           int(strokeColorMatches[2], 16),
+                           int(strokeColorMatches[3], 16),
+                           int(strokeColorMatches[4], 16))
+
+    @property
+    def font(self):
+        if self._face is None:
+            self._face = FaceCache.get(self.path, self.height)
+        return self._face
+
+    @property
+    def spaceUnits(self):
+        if self._spaceUnits is None:
+            self._spaceUnits = self.units(" ")
+        return self._spaceUnits
+
+    @property
+    def spaceLen(self):
+        return self.spaceUnits * self.height
+
+    def units(self, text):
+        # Length of the text per pixel of font height (see `MeasureCache`)
+        return MeasureCache.getUnits(self.path, text)
+
+    def getLength(self, text):
+        # Exact length of the text at the current height, with hinting
+        return self.font.getlength(text)
+
+    def resize(self, height):
+        self.height = height
+        self._face = None
+
+    def scaled(self, scale):
+        # A copy of the font at `scale` times the size, including its stroke
+        font = copy.copy(self)
+        font.height = max(1, round(self.height * scale))
+        font.stroke = max(1, round(self.stroke * scale)) if self.stroke > 0 else 0
+        font._face = None
+        return font
+
+    def imgDrawKwargs(self):
+        return {
+            "font" : self.font,
+            "fill" : self.rgba,
+            "stroke_width" : self.stroke,
+            "stroke_fill" : self.strokeRgba
+        }
+
+def charFontHeight(charSpec, baseHeight):
+    return max(1, int(baseHeight * charSpec["relative_height"]["value"]))
+
+def charStroke(charSpec, baseHeight):
+    return int(baseHeight * charSpec["stroke_width"]["value"])
+
+def loadFonts(charSpecs, baseHeight):
+    fonts = {}
+    for charSpec in charSpecs:
+        charFonts = {}
+        for font in ["font", "font_bold", "font_italic", "font_bolditalic"]:
+            height = charFontHeight(charSpec, baseHeight)
+            stroke = charStroke(charSpec, baseHeight)
+            charFonts[font] = Font(
+                charSpec[font]["value"], height, charSpec["color"]["value"],
+                stroke, charSpec["stroke_color"]["value"])
+        fonts[charSpec["name"]["value"]] = charFonts
+    return fonts
+
+def resizeFonts(fonts, charSpecs, baseHeight, restroke=False):
+    # Strokes are sized from the specification's base_font_height, not the height
+    # the text is fitted at, so they're only recomputed with `restroke` (e.g. when a
+    # layout starts from a specification with a different base_font_height)
+    for charSpec in charSpecs:
+        height = charFontHeight(charSpec, baseHeight)
+        for font in fonts[charSpec["name"]["value"]].values():
+            font.resize(height)
+            if restroke:
+                font.stroke = charStroke(charSpec, baseHeight)
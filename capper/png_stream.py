@@ -0,0 +1,70 @@
+import struct
+import zlib
+from PIL import Image, ImageChops
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Compressed data is written out in chunks of about this many bytes
+IDAT_SIZE = 1 << 16
+
+# Writes a PNG to a file a strip of rows at a time, so that the whole image never has
+# to be in memory. Every row is stored with PNG's "up" filter (its difference from the
+# row above), which ImageChops computes in C for a whole strip at once. On captions it
+# compresses about as well as the per-row filter choice Pillow makes.
+class PngWriter:
+    colorTypes = {"RGB" : 2, "RGBA" : 6}
+
+    def __init__(self, f, size, mode, compressLevel):
+        assert mode in PngWriter.colorTypes
+        self.f = f
+        self.size = size
+        self.mode = mode
+        self.compressor = zlib.compressobj(compressLevel)
+        self.pending = []
+        self.pendingSize = 0
+        self.rows = 0
+        self.bytesWritten = 0
+        # The row above the first one counts as all zeros
+        self.prevRow = Image.new(mode, (size[0], 1), 0)
+
+        self.f.write(PNG_SIGNATURE)
+        self.bytesWritten += len(PNG_SIGNATURE)
+        self.writeChunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8,
+                                             PngWriter.colorTypes[mode], 0, 0, 0))
+
+    def writeChunk(self, tag, data):
+        self.f.write(struct.pack(">I", len(data)) + tag + data +
+                     struct.pack(">I", zlib.crc32(tag + data)))
+        self.bytesWritten += 12 + len(data)
+
+    def compressed(self, data):
+        if data:
+            self.pending.append(data)
+            self.pendingSize += len(data)
+        if self.pendingSize >= IDAT_SIZE:
+            self.writeChunk(b"IDAT", b"".join(self.pending))
+            (self.pending, self.pendingSize) = ([], 0)
+
+    def write(self, strip):
+        # Appends the rows of `strip` below the rows written so far
+        assert strip.mode == self.mode and strip.width == self.size[0]
+        assert self.rows + strip.height <= self.size[1]
+        (width, height) = strip.size
+        above = Image.new(self.mode, strip.size)
+        above.paste(self.prevRow, (0, 0))
+        above.paste(strip.crop((0, 0, width, height - 1)), (0, 1))
+        filtered = ImageChops.subtract_modulo(strip, above).tobytes()
+        self.prevRow = strip.crop((0, height - 1, width, height))
+
+        stride = len(filtered) // height
+        rows = b"".join([b"\x02" + filtered[i * stride:(i + 1) * stride]
+                         for i in range(height)])
+        self.compressed(self.compressor.compress(rows))
+        self.rows += height
+
+    def close(self):
+        assert self.rows == self.size[1], "Expected every row to be written"
+        self.pending.append(self.compressor.flush())
+        self.writeChunk(b"IDAT", b"".join(self.pending))
+        (self.pending, self.pendingSize) = ([], 0)
+        self.writeChunk(b"IEND", b"")
+        return self.bytesWritten
@@ -1,28 +1,38 @@
 from pathlib import Path
-from PIL import Image
 from termcolor import cprint
 
 class Logging:
     width = 5
     tab = 8
+    # Set in batch workers so that concurrently rendered specifications don't
+    # interleave their logs. Results are reported by the parent process instead.
+    quiet = False
 
     @staticmethod
     def divider():
+        if Logging.quiet:
+            return
         print(f"+{'':->{Logging.width-2}}+")
 
     @staticmethod
     def header(text):
+        if Logging.quiet:
+            return
         Logging.divider()
         cprint(f"| {text}", attrs=["bold"])
 
     @staticmethod
     def subSection(text, levels=1, color="cyan"):
+        if Logging.quiet:
+            return
         print("| ", end="")
         cprint(f"{'': >{Logging.tab * levels}}{text}", color)
 
     @staticmethod
     def table(table, levels=1):
         assert len(table) > 0, "Expected log table to have at least one element"
+        if Logging.quiet:
+            return
         colls = len(table[0])
         tableStrs = []
 
@@ -55,7 +65,10 @@ class Logging:
 
     @staticmethod
     def filesizeStr(filename):
-        sizeBytes = Path(filename).stat().st_size
+        return Logging.sizeStr(Path(filename).stat().st_size)
+
+    @staticmethod
+    def sizeStr(sizeBytes):
         units = ["B", "KB", "MB", "GB", "TB"]
         for unit in units:
             if sizeBytes >= 1024:
@@ -64,8 +77,7 @@ class Logging:
                 return f"{sizeBytes:.2f} {unit:>2}"
 
     @staticmethod
-    def dimensionsStr(imgname):
-        img = Image.open(imgname)
+    def dimensionsStr(img):
         return f"{img.width}x{img.height} px"
 
 class UserError(Exception):
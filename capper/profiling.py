@@ -0,0 +1,128 @@
+from contextlib import contextmanager
+from functools import wraps
+import json
+import threading
+import time
+
+# Process-wide wall and CPU timings of each pipeline stage. Stages may nest (e.g.
+# font loading happens while parsing), in which case the outer stage is only charged
+# for the time spent outside of the inner one, so the stages add up to the total.
+# CPU time is measured per thread, so encodes running in parallel each get their own.
+class Profiler:
+    # Stage name -> [calls, wall seconds, CPU seconds], in the order stages first ran
+    stages = {}
+    lock = threading.Lock()
+    local = threading.local()
+
+    @staticmethod
+    @contextmanager
+    def stage(name):
+        stack = Profiler.local.__dict__.setdefault("stack", [])
+        # [wall, CPU] spent in nested stages
+        children = [0, 0]
+        stack.append(children)
+        (startWall, startCpu) = (time.perf_counter(), time.thread_time())
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - startWall
+            cpu = time.thread_time() - startCpu
+            stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            with Profiler.lock:
+                counters = Profiler.stages.setdefault(name, [0, 0, 0])
+                counters[0] += 1
+                counters[1] += wall - children[0]
+                counters[2] += cpu - children[1]
+
+    @staticmethod
+    def timed(name):
+        # Decorator that runs the whole function as one stage
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with Profiler.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def snapshot():
+        with Profiler.lock:
+            return {name : list(counters) for (name, counters) in Profiler.stages.items()}
+
+    @staticmethod
+    def add(stages):
+        # Adds timings taken elsewhere, e.g. the snapshot of a worker process
+        with Profiler.lock:
+            for (name, (calls, wall, cpu)) in stages.items():
+                counters = Profiler.stages.setdefault(name, [0, 0, 0])
+                counters[0] += calls
+                counters[1] += wall
+                counters[2] += cpu
+
+    @staticmethod
+    def clear():
+        with Profiler.lock:
+            Profiler.stages = {}
+
+    @staticmethod
+    def table(stages=None):
+        stages = Profiler.snapshot() if stages is None else stages
+        totalWall = sum([wall for (_, wall, _) in stages.values()])
+        table = [("Stage", "Calls", "Wall", "CPU", "Wall %")]
+        for (name, (calls, wall, cpu)) in stages.items():
+            percent = 100 * wall / totalWall if totalWall > 0 else 0
+            table.append((name, calls, f"{wall:.3f}s", f"{cpu:.3f}s", f"{percent:.1f}%"))
+        table.append(("Total", "", f"{totalWall:.3f}s",
+                      f"{sum([cpu for (_, _, cpu) in stages.values()]):.3f}s", ""))
+        return table
+
+    @staticmethod
+    def toJson(fileName, stages=None, caches=None):
+        # `caches` are statistics of caches (e.g. {"lines" : {"hits" : ...}}) to save
+        # along with the timings
+        stages = Profiler.snapshot() if stages is None else stages
+        data = {name : {"calls" : calls, "wall_s" : round(wall, 6), "cpu_s" : round(cpu, 6)}
+                for (name, (calls, wall, cpu)) in stages.items()}
+        with open(fileName, "w") as f:
+            json.dump({"stages" : data, "caches" : caches or {}}, f, indent=2)
+
+# Sums the stage timings of many renders, e.g. every specification of a batch
+class ProfileAggregate:
+    def __init__(self):
+        self.renders = 0
+        # Stage name -> [calls, wall seconds, CPU seconds, slowest render's wall]
+        self.stages = {}
+
+    def add(self, stages):
+        self.renders += 1
+        for (name, (calls, wall, cpu)) in stages.items():
+            totals = self.stages.setdefault(name, [0, 0, 0, 0])
+            totals[0] += calls
+            totals[1] += wall
+            totals[2] += cpu
+            totals[3] = max(totals[3], wall)
+
+    def table(self):
+        totalWall = sum([totals[1] for totals in self.stages.values()])
+        table = [("Stage", "Calls", "Total Wall", "Total CPU", "Mean Wall", "Max Wall",
+                  "Wall %")]
+        for (name, (calls, wall, cpu, maxWall)) in self.stages.items():
+            percent = 100 * wall / totalWall if totalWall > 0 else 0
+            table.append((name, calls, f"{wall:.3f}s", f"{cpu:.3f}s",
+                          f"{wall / self.renders:.3f}s", f"{maxWall:.3f}s",
+                          f"{percent:.1f}%"))
+        return table
+
+    def toJson(self, fileName, caches=None):
+        data = {name : {"calls" : calls, "wall_s" : round(wall, 6),
+                        "cpu_s" : round(cpu, 6),
+                        "mean_wall_s" : round(wall / self.renders, 6),
+                        "max_wall_s" : round(maxWall, 6)}
+                for (name, (calls, wall, cpu, maxWall)) in self.stages.items()}
+        with open(fileName, "w") as f:
+            json.dump({"renders" : self.renders, "stages" : data, "caches" : caches or {}},
+                      f, indent=2)
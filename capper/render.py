@@ -0,0 +1,850 @@
+import copy
+from functools import partial
+from math import ceil, floor
+import io
+import os
+from pathlib import Path
+import time
+from PIL import Image, ImageDraw
+
+from font_index import FontIndex
+from fonts import Font, MeasureCache, MetricsCache, loadFonts, resizeFonts
+from pretty_logging import Logging
+from png_stream import PngWriter
+from profiling import Profiler
+from spec_parse import UserSpec
+from text import wrapRegions, wrapRegionsOptimal, ParagraphCache, TextBox
+
+class TextBoxPos:
+    LEFT = "left"
+    RIGHT = "right"
+    SPLIT = "split"
+    # Columns of each named layout, from left to right
+    COLUMNS = {LEFT : ["text", "art"], RIGHT : ["art", "text"],
+               SPLIT : ["text", "art", "text"]}
+
+    @staticmethod
+    def columns(textBoxPos):
+        return textBoxPos if isinstance(textBoxPos, list) else TextBoxPos.COLUMNS[textBoxPos]
+
+def autoWidth(textHeight, fmtWords, textBoxPos, pages=1):
+    charCount = 0
+    for word in fmtWords:
+        for unit in word.fmtUnits:
+            charCount += len(unit.txt)
+
+    # The "magic" equation below was found using data from two column captions.
+    # Thus, adjust the character count for other column counts accorindgly.
+    textColumns = TextBoxPos.columns(textBoxPos).count("text")
+    if textColumns == 1:
+        charCount /= 1.25
+    elif textColumns > 2:
+        charCount *= 2 / textColumns
+
+    # These are "magic" numbers based off of data gathered from existing captions. As
+    # the character count of a caption increases, the number of characters per line
+    # tends to increase with the following linear curve.
+    # When the text is spread over several pages, each page is its own caption.
+    optimalCharsPerLine = (0.00449057 * charCount / pages) + 46.35
+
+    totalTextLen = 0
+    for word in fmtWords:
+        totalTextLen += word.actualLength
+    averageCharLenPx = totalTextLen/charCount
+    return optimalCharsPerLine * averageCharLenPx
+
+def openArt(artFilename):
+    # Only reads the header. The pixels are decoded by `scaleArt()` once the final
+    # size is known.
+    if artFilename is None:
+        return None
+    return Image.open(artFilename)
+
+def scaleArt(art, size):
+    # Decodes the art straight to `size`. Art larger than the target is shrunk as
+    # much as possible while decoding (in the DCT domain for JPEGs) or with a cheap
+    # box reduction, so the single high-quality resample only sees the pixels the
+    # caption needs. Returns (scaled art, art statistics table).
+    def imageBytes(img):
+        # Pillow pads every multi-band pixel to four bytes
+        if img.mode in ["1", "L", "P"]:
+            pixelBytes = 1
+        elif img.mode.startswith("I;16"):
+            pixelBytes = 2
+        else:
+            pixelBytes = 4
+        return pixelBytes * img.width * img.height
+
+    originalSize = art.size
+    startTime = time.time()
+    scale = 1
+    with Profiler.stage("Art decoding"):
+        if art.format == "JPEG" and art.draft(art.mode, size) is not None:
+            scale = art.decoderconfig[0]
+        art.load()
+        if art.mode in ["1", "P"]:
+            # Palette images can only be resampled with nearest neighbor
+            art = art.convert("RGBA")
+        peakBytes = imageBytes(art)
+        if scale == 1:
+            # Box reductions alias, so stay at least twice the target size and leave
+            # the rest to the resample
+            scale = max(1, min(art.width // (2 * size[0]), art.height // (2 * size[1])))
+            if scale > 1:
+                reducedArt = art.reduce(scale)
+                peakBytes += imageBytes(reducedArt)
+                art = reducedArt
+    decodeTime = time.time() - startTime
+    decodedSize = art.size
+
+    startTime = time.time()
+    # Reduced images round their dimensions up, so only resample the area the
+    # original image covers
+    box = (0, 0, originalSize[0] / scale, originalSize[1] / scale)
+    with Profiler.stage("Art resizing"):
+        scaledArt = art.resize(size, Image.Resampling.LANCZOS, box=box)
+    resizeTime = time.time() - startTime
+    peakBytes = max(peakBytes, imageBytes(art) + imageBytes(scaledArt))
+
+    artInfoTable = [
+        ("Art Size", f"{originalSize[0]}x{originalSize[1]} px"),
+        ("Decoded Size", f"{decodedSize[0]}x{decodedSize[1]} px (1/{scale} scale)"),
+        ("Scaled Size", f"{size[0]}x{size[1]} px"),
+        ("Decode Time", f"{decodeTime:.3f}s"),
+        ("Resize Time", f"{resizeTime:.3f}s"),
+        ("Peak Art Memory", Logging.sizeStr(peakBytes)),
+    ]
+    return (scaledArt, artInfoTable)
+
+# A caption that is only drawn a strip at a time, as it's written (see `drawStrips()`)
+class StripCaption:
+    def __init__(self, renderer, textBoxes, art, stripHeight):
+        ((self.width, self.height), _) = renderer.captionPlacements(textBoxes, art)
+        self.size = (self.width, self.height)
+        self.mode = renderer.colorMode()
+        self.stripHeight = stripHeight
+        self.strips = partial(renderer.drawStrips, textBoxes, art, stripHeight)
+
+# Renders captions from a `UserSpec` without touching module globals or the disk
+# (beyond reading the text, art and fonts the specification points to). A renderer
+# keeps its own fonts, parsed paragraphs and decoded art between calls to `layout()`,
+# so rendering the same specification again only redoes the work that changed. A
+# renderer handles one render at a time; use one renderer per thread.
+class Renderer:
+    def __init__(self, spec, text=None, artCache=None):
+        if not isinstance(spec, UserSpec):
+            with Profiler.stage("Spec validation"):
+                spec = UserSpec("<request>", spec=spec, inlineText=text)
+        elif text is not None:
+            spec = copy.copy(spec)
+            spec.inlineText = text
+        self.baseSpec = spec
+        # The filled-in copy of the specification from the latest `layout()`
+        self.spec = None
+        # Text boxes and credits rasterized during the latest `layout()`
+        self.layers = {}
+        self.fonts = loadFonts(spec.characters, spec.text["base_font_height"]["value"])
+        self.paragraphs = ParagraphCache(self.fonts, spec.characters[0]["name"]["value"])
+        self.artCache = {} if artCache is None else artCache
+
+    def withSpec(self, spec):
+        # A renderer for a variant of this specification with the same characters,
+        # text, and art, which shares this renderer's fonts, parsed paragraphs, and
+        # scaled art. Fonts are resized by every layout, so only one of the renderers
+        # may lay out or draw at a time.
+        renderer = copy.copy(self)
+        renderer.baseSpec = spec
+        renderer.spec = None
+        renderer.layers = {}
+        return renderer
+
+    def readText(self):
+        if self.spec.inlineText is not None:
+            Logging.header("Reading and fitting text")
+            return self.spec.inlineText
+
+        Logging.header(f"Reading and fitting text from '{self.spec.text['text']['value']}'")
+        with open(self.spec.text["text"]["value"], "r",encoding="utf-8") as f:
+            return f.read()
+
+    def beginLayout(self):
+        # Rendering fills in automatic values, so every layout starts from a fresh
+        # copy of the specification. The credits character `drawCredits()` adds is
+        # sized from the art, so it has to be recreated too.
+        self.spec = copy.deepcopy(self.baseSpec)
+        self.layers = {}
+        # The measuring statistics printed by `finishLayout()` are for this layout
+        MeasureCache.resetStats()
+        if "credits" not in [char["name"]["value"] for char in self.spec.characters]:
+            self.fonts.pop("credits", None)
+
+        textInfoTable = []
+        baseFontHeight = self.spec.text["base_font_height"]["value"]
+        text = self.readText()
+        with Profiler.stage("Parsing"):
+            fmtWords = self.paragraphs.parse(text)
+            self.checkGlyphs(fmtWords)
+        with Profiler.stage("Measuring"):
+            # Words kept from an earlier layout are still sized for the font height
+            # it settled on, so every layout starts from the specification's again.
+            # Strokes are reset too, since a renderer from `withSpec()` shares the
+            # fonts of a specification that may have another base_font_height.
+            resizeFonts(self.fonts, self.spec.characters, baseFontHeight, restroke=True)
+            for word in fmtWords:
+                word.remeasure()
+
+        textInfoTable.append(
+            ("Word Count", sum([1 for word in fmtWords if word.fmtUnits != []])))
+        return (fmtWords, textInfoTable)
+
+    def finishLayout(self, textInfoTable):
+        textInfoTable.append(("Base Font Height",
+                              self.spec.text["base_font_height"]["value"]))
+        Logging.subSection("Successfully manipulated text!", 1, "green")
+        Logging.table(textInfoTable)
+        measureTable = MeasureCache.statsTable()
+        # Layouts that reuse every parsed paragraph measure nothing
+        if len(measureTable) > 1:
+            Logging.table(measureTable)
+        with Profiler.stage("Saving metrics"):
+            MetricsCache.save()
+
+    def layout(self):
+        (fmtWords, textInfoTable) = self.beginLayout()
+        baseFontHeight = self.spec.text["base_font_height"]["value"]
+        textBoxPos = self.spec.text["text_box_pos"]["value"]
+        if self.spec.text["text_width"]["default"]:
+            baseTextWidth = autoWidth(baseFontHeight, fmtWords, textBoxPos)
+            self.spec.text["text_width"]["value"] = round(baseTextWidth / baseFontHeight, 2)
+        else:
+            baseTextWidth = self.spec.text["text_width"]["value"] * baseFontHeight
+        Logging.subSection("Wrapping parsed text")
+        textBoxes = self.layoutText(fmtWords, baseFontHeight, baseTextWidth)
+
+        art = openArt(self.spec.image["art"]["value"])
+
+        if not self.spec.text["base_font_height"]["default"]:
+            baseImgHeight = max([textBox.height for textBox in textBoxes])
+        elif not self.spec.image["image_height"]["default"]:
+            baseImgHeight = self.spec.image["image_height"]["value"]
+        else:
+            baseImgHeight = None
+        (textBoxes, art) = self.autoRescale(fmtWords, textBoxes, art, baseImgHeight)
+        with Profiler.stage("Measuring glyphs"):
+            for textBox in textBoxes:
+                textBox.measure()
+
+        if len(textBoxes) == 1:
+            textInfoTable.append(("Line Count", len(textBoxes[0].fmtLines)))
+        elif textBoxPos == TextBoxPos.SPLIT:
+            textInfoTable.append(("Line Count (left)", len(textBoxes[0].fmtLines)))
+            textInfoTable.append(("Line Count (right)", len(textBoxes[1].fmtLines)))
+        else:
+            for i, textBox in enumerate(textBoxes):
+                textInfoTable.append((f"Line Count (column {i + 1})", len(textBox.fmtLines)))
+        self.finishLayout(textInfoTable)
+        return (textBoxes, art)
+
+    def layoutPages(self):
+        # Returns (pages, art), where each page is the list of text boxes of one
+        # caption. Without pagination, the whole text is a single page.
+        if not self.baseSpec.text["paginate"]["value"]:
+            (textBoxes, art) = self.layout()
+            return ([textBoxes], art)
+
+        (fmtWords, textInfoTable) = self.beginLayout()
+        # Every page uses the same font height and text width so that the series
+        # reads evenly
+        baseFontHeight = self.spec.text["base_font_height"]["value"]
+        pageHeight = self.spec.text["page_height"]["value"]
+        if pageHeight is None:
+            pageHeight = (self.spec.image["image_height"]["value"] or
+                          self.spec.image["max_image_height"]["value"])
+            self.spec.text["page_height"]["value"] = pageHeight
+        textBoxPos = self.spec.text["text_box_pos"]["value"]
+        textColumns = TextBoxPos.columns(textBoxPos).count("text")
+
+        Logging.subSection("Wrapping parsed text")
+        if self.spec.text["text_width"]["default"]:
+            # The page count depends on the width, so estimate it from the width the
+            # whole text would get, then size the text for that many pages
+            textWidth = autoWidth(baseFontHeight, fmtWords, textBoxPos)
+            textBox = self.wrapText(fmtWords, baseFontHeight, textWidth)
+            pageEstimate = max(1, ceil(textBox.height / (pageHeight * textColumns)))
+            textWidth = autoWidth(baseFontHeight, fmtWords, textBoxPos, pageEstimate)
+            self.spec.text["text_width"]["value"] = round(textWidth / baseFontHeight, 2)
+        (textBox, pages) = self.fitPages(fmtWords, pageHeight, textColumns)
+
+        art = openArt(self.spec.image["art"]["value"])
+        (_, art) = self.autoRescale(fmtWords, pages[0], art, pageHeight, fit=False)
+        with Profiler.stage("Measuring glyphs"):
+            for page in pages:
+                for pageBox in page:
+                    pageBox.measure()
+            # Every page is as wide as the widest one
+            lineLen = max([pageBox.maxLineLen for page in pages for pageBox in page])
+            for page in pages:
+                for pageBox in page:
+                    pageBox.widen(lineLen)
+
+        textInfoTable.append(("Page Count", len(pages)))
+        textInfoTable.append(("Page Height", pageHeight))
+        textInfoTable.append(("Line Count (total)", len(textBox.fmtLines)))
+        self.finishLayout(textInfoTable)
+        return (pages, art)
+
+    def fitPages(self, fmtWords, pageHeight, textColumns, maxIterations=64):
+        # Paginating at base_font_height gives the fewest pages the text fits on.
+        # Search for the largest font height that still fits the text on that many
+        # pages, so that they're as full as they can be. The text width scales with
+        # the font height. Returns (all of the wrapped text, pages).
+        startTime = time.time()
+        widthRatio = self.spec.text["text_width"]["value"]
+        fitting = {}
+
+        def paginated(fontHeight):
+            textBox = self.wrapText(fmtWords, fontHeight, widthRatio * fontHeight)
+            with Profiler.stage("Paginating"):
+                return (textBox, self.paginate(textBox, pageHeight, textColumns))
+
+        def fits(fontHeight, pageCount):
+            if fontHeight not in fitting:
+                pages = paginated(fontHeight)[1]
+                fitting[fontHeight] = (len(pages) <= pageCount and
+                    max([box.height for page in pages for box in page]) <= pageHeight)
+            return fitting[fontHeight]
+
+        fontHeight = self.spec.text["base_font_height"]["value"]
+        pageCount = len(paginated(fontHeight)[1])
+        # Double the font height until the text no longer fits, then bisect
+        (lo, hi) = (fontHeight, None)
+        while hi is None and len(fitting) < maxIterations:
+            if fits(lo * 2, pageCount):
+                lo *= 2
+            else:
+                hi = lo * 2
+        while hi is not None and lo + 1 < hi and len(fitting) < maxIterations:
+            mid = (lo + hi) // 2
+            (lo, hi) = (mid, hi) if fits(mid, pageCount) else (lo, mid)
+
+        self.spec.text["base_font_height"]["value"] = lo
+        (textBox, pages) = paginated(lo)
+        Logging.subSection(f"Fit text to {len(pages)} page(s) at a font height of {lo} " \
+                           f"in {len(fitting) + 1} iterations " \
+                           f"({time.time() - startTime:.3f}s)", 2)
+        return (textBox, pages)
+
+    def paginate(self, textBox, pageHeight, textColumns):
+        # Streams the wrapped lines onto pages, starting a new page whenever the next
+        # paragraph wouldn't fit on the current one. Paragraphs too tall for a page of
+        # their own are cut between lines instead. Blank lines between paragraphs are
+        # dropped at the top of a page.
+        def pageBoxes(lines):
+            pageBox = TextBox(lines, textBox.baseHeight, textBox.lineSpacing,
+                              textBox.padding)
+            return [pageBox] if textColumns == 1 else pageBox.split(textColumns)
+
+        def fits(lines):
+            return max([box.height for box in pageBoxes(lines)]) <= pageHeight
+
+        paragraphs = [[]]
+        for line in textBox.fmtLines:
+            if line.isNewline() and paragraphs[-1] and not paragraphs[-1][-1].isNewline():
+                paragraphs.append([])
+            paragraphs[-1].append(line)
+
+        pages = []
+        page = []
+        for paragraph in paragraphs:
+            if not page:
+                while paragraph and paragraph[0].isNewline():
+                    paragraph = paragraph[1:]
+            if not paragraph:
+                continue
+            if fits(page + paragraph):
+                page += paragraph
+                continue
+            if page:
+                pages.append(page)
+                page = []
+                while paragraph and paragraph[0].isNewline():
+                    paragraph = paragraph[1:]
+            for line in paragraph:
+                if page and not fits(page + [line]):
+                    pages.append(page)
+                    page = []
+                if page or not line.isNewline():
+                    page.append(line)
+        if page or not pages:
+            pages.append(page)
+        return [pageBoxes(page) for page in pages]
+
+    def checkGlyphs(self, fmtWords):
+        # Characters a font has no glyph for are drawn as empty boxes
+        fontChars = {}
+        for word in fmtWords:
+            for unit in word.fmtUnits:
+                fontChars.setdefault(unit.font.path, set()).update(unit.txt)
+        for (path, chars) in fontChars.items():
+            missing = sorted(FontIndex.missingChars(path, chars - {" "}))
+            if missing:
+                missingStr = ", ".join([f"'{char}' (U+{ord(char):04X})" for char in missing[:8]])
+                if len(missing) > 8:
+                    missingStr += f", and {len(missing) - 8} more"
+                Logging.subSection(f"'{Path(path).name}' has no glyphs for {missingStr}",
+                                   2, "yellow")
+
+    def wrapText(self, fmtWords, baseFontHeight, textWidth):
+        # Returns all of the text wrapped into a single text box
+        with Profiler.stage("Measuring"):
+            resizeFonts(self.fonts, self.spec.characters, baseFontHeight)
+            for word in fmtWords:
+                word.remeasure()
+
+        with Profiler.stage("Wrapping"):
+            if self.spec.text["wrap_mode"]["value"] == "optimal":
+                wrappedText = wrapRegionsOptimal(fmtWords, textWidth)
+            else:
+                wrappedText = wrapRegions(fmtWords, textWidth)
+            return TextBox(wrappedText, baseFontHeight,
+                           int(self.spec.text["line_spacing"]["value"] * baseFontHeight),
+                           int(self.spec.text["padding"]["value"] * baseFontHeight))
+
+    def layoutText(self, fmtWords, baseFontHeight, textWidth):
+        textBoxes = [self.wrapText(fmtWords, baseFontHeight, textWidth)]
+        textColumns = TextBoxPos.columns(self.spec.text["text_box_pos"]["value"]).count("text")
+        if textColumns > 1:
+            with Profiler.stage("Splitting"):
+                textBoxes = textBoxes[0].split(textColumns)
+        return textBoxes
+
+    def fitText(self, fmtWords, textBoxes, targetHeight, maxIterations=64):
+        # Since PIL only allows whole number font heights, scaling every font by the
+        # same factor rarely lands on the target height. Instead, search for the
+        # largest base font height (and, if it was picked automatically, the narrowest
+        # text width within 15% of the automatic one) whose re-wrapped text still fits
+        # the target.
+        startTime = time.time()
+        searchWidth = self.spec.text["text_width"]["default"]
+        # Text widths are searched in thousandths so that they're exactly reproducible
+        # from the autospec.
+        widthRatio = round(self.spec.text["text_width"]["value"] * 1000)
+        heights = {}
+
+        def textHeight(fontHeight, ratio):
+            if (fontHeight, ratio) not in heights:
+                boxes = self.layoutText(fmtWords, fontHeight, ratio * fontHeight / 1000)
+                heights[(fontHeight, ratio)] = max([box.height for box in boxes])
+            return heights[(fontHeight, ratio)]
+
+        def fits(fontHeight, ratio):
+            return textHeight(fontHeight, ratio) <= targetHeight
+
+        currHeight = max([textBox.height for textBox in textBoxes])
+        fontHeight = max(1, int(self.spec.text["base_font_height"]["value"] *
+                                targetHeight / currHeight))
+        while (fontHeight > 1 and not fits(fontHeight, widthRatio) and
+               len(heights) < maxIterations):
+            fontHeight -= 1
+        while fits(fontHeight + 1, widthRatio) and len(heights) < maxIterations:
+            fontHeight += 1
+        best = (fontHeight, widthRatio)
+
+        for candidateHeight in ([fontHeight, fontHeight + 1] if searchWidth else []):
+            if targetHeight - textHeight(*best) < 1:
+                break
+            # Wider text wraps into fewer lines, so the narrowest width that fits gives
+            # the tallest text.
+            (lo, hi) = (int(widthRatio * 0.85), int(widthRatio * 1.15))
+            if not fits(candidateHeight, hi):
+                continue
+            while lo < hi and len(heights) < maxIterations:
+                mid = (lo + hi) // 2
+                if fits(candidateHeight, mid):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            if textHeight(candidateHeight, hi) > textHeight(*best):
+                best = (candidateHeight, hi)
+
+        if not fits(*best):
+            # The search ran out of iterations before finding a size that fits, so
+            # fall back to the tallest text it did see fit. If the text overflows even
+            # at the smallest font, `autoRescale()` grows the image to fit it instead.
+            fitting = [key for (key, height) in heights.items() if height <= targetHeight]
+            if fitting:
+                best = max(fitting, key=lambda key : (heights[key], key))
+
+        (fontHeight, widthRatio) = best
+        self.spec.text["base_font_height"]["value"] = fontHeight
+        if searchWidth:
+            self.spec.text["text_width"]["value"] = widthRatio / 1000
+        textBoxes = self.layoutText(fmtWords, fontHeight, widthRatio * fontHeight / 1000)
+        Logging.subSection(f"Fit text to {max([box.height for box in textBoxes])}px " \
+                           f"(target {targetHeight}px) in {len(heights)} iterations " \
+                           f"({time.time() - startTime:.3f}s)", 2)
+        return textBoxes
+
+    @Profiler.timed("Rescaling")
+    def autoRescale(self, fmtWords, textBoxes, art, imgHeight=None, fit=True):
+        logStr = "Automatically rescaling text"
+        if art is not None:
+            logStr += " and art"
+        Logging.subSection(logStr)
+        textScaleHeight = max([textBox.height for textBox in textBoxes])
+
+        if imgHeight is None:
+            imgHeight = textScaleHeight if art is None else max(textScaleHeight, art.height)
+            imgHeight = min(imgHeight, self.spec.image["max_image_height"]["value"])
+
+        if fit and self.spec.text["base_font_height"]["default"]:
+            textBoxes = self.fitText(fmtWords, textBoxes, imgHeight)
+            # Text that doesn't fit the target would be cut off at the top and bottom
+            imgHeight = max([imgHeight] + [textBox.height for textBox in textBoxes])
+
+        # Any height the text still falls short of the target is split evenly above
+        # and below the text boxes, so the art is resampled once, straight to the
+        # target.
+        self.spec.image["image_height"]["value"] = imgHeight
+
+        if art is None:
+            return (textBoxes, None)
+
+        artScale = imgHeight / art.height
+        return (textBoxes, self.scaleArt(art, (int(art.width * artScale), imgHeight)))
+
+    def scaleArt(self, art, size):
+        # Keep the scaled art around for as long as the file doesn't change and the
+        # caption stays the same height
+        artFilename = self.spec.image["art"]["value"]
+        key = (os.stat(artFilename).st_mtime_ns, size)
+        if artFilename in self.artCache and self.artCache[artFilename][0] == key:
+            art.close()
+            return self.artCache[artFilename][1]
+
+        (scaledArt, artInfoTable) = scaleArt(art, size)
+        art.close()
+        Logging.table(artInfoTable)
+        self.artCache[artFilename] = (key, scaledArt)
+        return scaledArt
+
+    def bgColor(self):
+        matches = self.spec.rgbaRe.fullmatch(self.spec.image["bg_color"]["value"])
+        return (int(matches[1], 16), int(matches[2], 16),
+                int(matches[3], 16), int(matches[4], 16))
+
+    def colorMode(self):
+        return "RGB" if self.spec.output["output_img_format"]["value"] in ["jpg", "jpeg"] \
+               else "RGBA"
+
+    @Profiler.timed("Drawing credits")
+    def creditsLayer(self, art):
+        # Returns (coverage mask, top left corner relative to the art, ink), or None
+        # when the caption has no credits
+        capCredits = "\n".join(self.spec.text["credits"]["value"])
+        creditsPos = self.spec.text["credits_pos"]["value"]
+        if capCredits == "":
+            return None
+        if "credits" in self.layers:
+            return self.layers["credits"]
+
+        if "credits" in self.fonts:
+            font = self.fonts["credits"]["font"]
+        else:
+            baseFont = self.fonts[self.spec.characters[0]["name"]["value"]]["font"]
+            font = Font(baseFont.path, ceil(art.height * 0.02), baseFont.color, 0,
+                        "#00000000")
+            self.fonts["credits"] = {}
+            self.fonts["credits"]["font"] = font
+            creditsChar = {}
+            creditsCharSpec = {
+                "name" : "credits",
+                "color" : baseFont.color,
+                "font" : baseFont.path,
+                "relative_height" :
+                    font.height/self.spec.text["base_font_height"]["value"]
+            }
+            UserSpec.checkKeys(creditsCharSpec,
+                               self.spec.characterValidKeys,
+                               self.spec.characterRequiredKeys,
+                               creditsChar)
+            self.spec.validateAndSetChar(creditsCharSpec, creditsChar)
+            self.spec.characters.append(creditsChar)
+
+        padding = font.height
+        (artWidth, artHeight) = art.size
+
+        fontKwargs = font.imgDrawKwargs()
+        fontKwargs.pop("fill")
+        fontKwargs.pop("stroke_fill")
+        d = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+        (_, _, creditsWidth, creditsHeight) = \
+            d.multiline_textbbox((0, 0), capCredits, **fontKwargs)
+        # When creating a bounding box at (0, 0), PIL doesn't put the top left corner
+        # at exactly (0, 0). Manually correct this by adding an offset.
+        creditsWidth += 1
+        creditsHeight += 3
+        if creditsPos == "tl":
+            (topLeft, align) = ((padding, padding), "left")
+        elif creditsPos == "tr":
+            (topLeft, align) = ((artWidth - (creditsWidth + padding), padding), "right")
+        elif creditsPos == "bl":
+            (topLeft, align) = ((padding, artHeight - (creditsHeight + padding)), "left")
+        elif creditsPos == "br":
+            (topLeft, align) = ((artWidth - (creditsWidth + padding),
+                                 artHeight - (creditsHeight + padding)), "right")
+
+        # Only the area the credits actually cover is rasterized. The mask is offset
+        # by whole pixels so the text keeps its subpixel position.
+        (left, top, right, bottom) = d.multiline_textbbox(topLeft, capCredits,
+                                                          align=align, **fontKwargs)
+        (left, top) = (floor(left), floor(top))
+        mask = Image.new("L", (max(1, ceil(right) - left), max(1, ceil(bottom) - top)), 0)
+        ImageDraw.Draw(mask).multiline_text((topLeft[0] - left, topLeft[1] - top),
+                                            capCredits, align=align, fill=255,
+                                            **fontKwargs)
+        self.layers["credits"] = (mask, (left, top), font.rgba)
+        return self.layers["credits"]
+
+    def pasteCredits(self, img, artX, artY, art):
+        layer = self.creditsLayer(art)
+        if layer is None:
+            return
+        # Filling through the coverage mask blends exactly like `ImageDraw` does when
+        # it draws text, so every output matches drawing the credits directly.
+        (mask, (x, y), ink) = layer
+        img.paste(ink, (artX + x, artY + y, artX + x + mask.width, artY + y + mask.height),
+                  mask)
+
+    @Profiler.timed("Drawing text")
+    def textLayer(self, textBox):
+        # Stroked text is the most expensive thing to draw, so each text box is drawn
+        # once per layout and the same image is reused by every output
+        if textBox not in self.layers:
+            img = Image.new(self.colorMode(), (textBox.width, textBox.height),
+                            self.bgColor())
+            textBox.drawText(ImageDraw.Draw(img), self.spec.text["alignment"]["value"])
+            self.layers[textBox] = img
+        return self.layers[textBox]
+
+    def captionPlacements(self, textBoxes, art):
+        # Returns the (width, height) of the caption, and ("art" or "text", x, y, art
+        # or text box) for each of its columns. Every text column is as wide as the
+        # widest text box, which is centered in it.
+        columns = TextBoxPos.columns(self.spec.text["text_box_pos"]["value"])
+        assert len(textBoxes) == columns.count("text")
+        maxTextBoxWidth = max([textBox.width for textBox in textBoxes])
+
+        placements = []
+        x = 0
+        textBoxIter = iter(textBoxes)
+        for column in columns:
+            if column == "art":
+                placements.append(("art", x, 0, art))
+                x += art.width
+            else:
+                textBox = next(textBoxIter)
+                placements.append(("text", x + int((maxTextBoxWidth - textBox.width)/2),
+                                   int((art.height - textBox.height)/2), textBox))
+                x += maxTextBoxWidth
+        return ((x, art.height), placements)
+
+    @Profiler.timed("Compositing")
+    def drawCaption(self, textBoxes, art):
+        (dimensions, placements) = self.captionPlacements(textBoxes, art)
+        img = Image.new(self.colorMode(), dimensions, self.bgColor())
+        for (column, x, y, layer) in placements:
+            if column == "art":
+                img.paste(layer, (x, y))
+                self.pasteCredits(img, x, y, layer)
+            else:
+                img.paste(self.textLayer(layer), (x, y))
+        return img
+
+    @Profiler.timed("Compositing")
+    def drawStrip(self, width, placements, top, height):
+        # Draws the rows [top, top + height) of the caption `placements` describe,
+        # exactly as `drawCaption()` would. Text boxes are drawn straight into the
+        # strip, clipped to the box like `textLayer()` does, and only the lines that
+        # reach into the strip are rasterized.
+        img = Image.new(self.colorMode(), (width, height), self.bgColor())
+        for (column, x, y, layer) in placements:
+            if column == "art":
+                img.paste(layer, (x, y - top))
+                self.pasteCredits(img, x, y - top, layer)
+                continue
+            (boxTop, boxBottom) = (max(y, top), min(y + layer.height, top + height))
+            if boxTop >= boxBottom:
+                continue
+            with Profiler.stage("Drawing text"):
+                boxImg = Image.new(self.colorMode(), (layer.width, boxBottom - boxTop),
+                                   self.bgColor())
+                layer.drawText(ImageDraw.Draw(boxImg), self.spec.text["alignment"]["value"],
+                               0, y - boxTop, clip=(0, boxImg.height))
+                img.paste(boxImg, (x, boxTop - top))
+        return img
+
+    def drawStrips(self, textBoxes, art, stripHeight):
+        # Yields the caption `drawCaption()` would draw as strips of `stripHeight`
+        # rows, top to bottom, so that no more than one strip is in memory at a time
+        ((width, height), placements) = self.captionPlacements(textBoxes, art)
+        for top in range(0, height, stripHeight):
+            yield self.drawStrip(width, placements, top, min(stripHeight, height - top))
+
+    @Profiler.timed("Compositing")
+    def drawArt(self, art):
+        img = Image.new(self.colorMode(), (art.width, art.height), self.bgColor())
+        img.paste(art, (0, 0))
+        return img
+
+    @Profiler.timed("Compositing")
+    def drawCreditsOnly(self, art):
+        img = Image.new(self.colorMode(), (art.width, art.height), self.bgColor())
+        self.pasteCredits(img, 0, 0, art)
+        return img
+
+    def outputGroups(self, pages, art, strips=False):
+        # Returns (page suffix, draw) for every group of image outputs in the
+        # specification, in the order they should be written. `draw()` returns
+        # (filename suffix, description, image) for each image of the group. Images
+        # are only drawn when asked for, so that a paginated caption never has every
+        # page in memory at once. With `strips`, captions of specifications with a
+        # strip_height are returned as `StripCaption`s to be drawn as they're written.
+        outputs = self.spec.output["outputs"]["value"]
+        stripHeight = self.spec.output["strip_height"]["value"] if strips else None
+        groups = []
+
+        def caption(textBoxes):
+            if stripHeight is not None:
+                return StripCaption(self, textBoxes, art, stripHeight)
+            return self.drawCaption(textBoxes, art)
+
+        def pageImages(textBoxes):
+            images = []
+            if "caption" in outputs:
+                images.append(("_cap", "caption", caption(textBoxes)))
+            if "text" in outputs:
+                for i, box in enumerate(textBoxes):
+                    images.append((f"_text{i}", "text-only image", self.textLayer(box)))
+            # The page is never drawn again, so don't hold on to its text
+            for box in textBoxes:
+                self.layers.pop(box, None)
+            return images
+
+        if self.spec.text["paginate"]["value"]:
+            for (i, textBoxes) in enumerate(pages):
+                groups.append((f"_{i + 1:02}", partial(pageImages, textBoxes)))
+        else:
+            if "caption" in outputs:
+                groups.append(("", lambda : [("_cap", "caption", caption(pages[0]))]))
+            if "text" in outputs:
+                for i, box in enumerate(pages[0]):
+                    groups.append(("", partial(lambda i, box : [(f"_text{i}",
+                                   "text-only image", self.textLayer(box))], i, box)))
+        if "art" in outputs and art is not None:
+            groups.append(("", lambda : [("_art", "rescaled art", self.drawArt(art))]))
+        if "credits" in outputs and art is not None and self.spec.text["credits"]["value"]:
+            groups.append(("", lambda : [("_credits", "credits",
+                                          self.drawCreditsOnly(art))]))
+        return groups
+
+    def drawOutputs(self, textBoxes, art):
+        # Returns (filename suffix, description, image) for every image output of a
+        # single page, in the order they should be written.
+        return [image for (_, draw) in self.outputGroups([textBoxes], art)
+                for image in draw()]
+
+    def preview(self, pages, art, scale):
+        # Returns (renderer, pages, art) that draw the laid out pages at `scale` times
+        # their size. Every line keeps exactly the words it has at full size; only
+        # the fonts, spacing, and art are scaled down. The returned renderer has its
+        # own fonts and copy of the specification, so this one is left untouched.
+        renderer = copy.copy(self)
+        renderer.spec = copy.deepcopy(self.spec)
+        renderer.layers = {}
+        renderer.fonts = {}
+        scaledFonts = {}
+        for (name, charFonts) in self.fonts.items():
+            renderer.fonts[name] = {}
+            for (variant, font) in charFonts.items():
+                scaledFonts[font] = font.scaled(scale)
+                renderer.fonts[name][variant] = scaledFonts[font]
+
+        with Profiler.stage("Measuring glyphs"):
+            pages = [[textBox.scaled(scale, scaledFonts.__getitem__)
+                      for textBox in textBoxes] for textBoxes in pages]
+        with Profiler.stage("Art resizing"):
+            art = art.resize((max(1, round(art.width * scale)),
+                              max(1, round(art.height * scale))),
+                             Image.Resampling.BILINEAR, reducing_gap=2.0)
+        return (renderer, pages, art)
+
+    def encodeSettings(self, preset=None):
+        # Returns (Pillow format, save() arguments, description) for an encode preset.
+        # Defaults to the specification's preset.
+        outputFmt = self.spec.output["output_img_format"]["value"]
+        quality = self.spec.output["output_img_quality"]["value"]
+        if preset is None:
+            preset = self.spec.output["encode_preset"]["value"]
+        pilFormat = Image.registered_extensions()["." + outputFmt]
+
+        if pilFormat == "PNG":
+            level = {"fast" : 1, "balanced" : 6, "smallest" : 9}[preset]
+            optimize = preset == "smallest"
+            kwargs = {"compress_level" : level, "optimize" : optimize}
+            description = f"level {level}" + (", optimize" if optimize else "")
+        elif pilFormat == "JPEG":
+            (optimize, progressive) = {"fast" : (False, False),
+                                       "balanced" : (True, False),
+                                       "smallest" : (True, True)}[preset]
+            kwargs = {"quality" : quality, "optimize" : optimize,
+                      "progressive" : progressive, "subsampling" : "4:2:0"}
+            description = f"quality {quality}, 4:2:0" + \
+                          (", optimize" if optimize else "") + \
+                          (", progressive" if progressive else "")
+        elif pilFormat == "WEBP":
+            # The highest quality is written losslessly, in which case "quality" is
+            # how hard the encoder tries to shrink the file. Lossless methods above 4
+            # take far longer without making captions any smaller.
+            if quality == 100:
+                (effort, method) = {"fast" : (0, 0), "balanced" : (50, 4),
+                                    "smallest" : (100, 4)}[preset]
+                kwargs = {"lossless" : True, "quality" : effort, "method" : method}
+                description = f"lossless, effort {effort}, method {method}"
+            else:
+                method = {"fast" : 0, "balanced" : 4, "smallest" : 6}[preset]
+                kwargs = {"quality" : quality, "method" : method}
+                description = f"quality {quality}, method {method}"
+        else:
+            speed = {"fast" : 10, "balanced" : 6, "smallest" : 4}[preset]
+            kwargs = {"quality" : quality, "speed" : speed}
+            description = f"quality {quality}, speed {speed}"
+        return (pilFormat, kwargs, f"{preset} ({description})")
+
+    def encode(self, img, preset=None):
+        (pilFormat, kwargs, _) = self.encodeSettings(preset)
+        buffer = io.BytesIO()
+        img.save(buffer, format=pilFormat, **kwargs)
+        return buffer.getvalue()
+
+    def encodeStrips(self, caption, f, stage):
+        # Streams a `StripCaption` into a PNG file, drawing it one strip at a time.
+        # Returns (bytes written, description of the settings).
+        (pilFormat, kwargs, _) = self.encodeSettings()
+        assert pilFormat == "PNG"
+        level = kwargs["compress_level"]
+        writer = PngWriter(f, caption.size, caption.mode, level)
+        for strip in caption.strips():
+            with Profiler.stage(stage):
+                writer.write(strip)
+        with Profiler.stage(stage):
+            size = writer.close()
+        preset = self.spec.output["encode_preset"]["value"]
+        return (size, f"{preset} (level {level}, {caption.stripHeight} px strips)")
+
+    def render(self):
+        # Lays out the text and returns {filename suffix: image} for every image output
+        (pages, art) = self.layoutPages()
+        return {suffix + pageSuffix: img for (pageSuffix, draw) in self.outputGroups(pages, art)
+                for (suffix, _, img) in draw()}
@@ -0,0 +1,130 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+from pretty_logging import Logging
+
+class ServerStats:
+    # Number of recent requests latencies are computed over
+    window = 10000
+    # Requests per second are reported over this many trailing seconds
+    rateSeconds = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+        self.requests = 0
+        self.errors = 0
+        # (finish time, latency) of the most recent requests
+        self.recent = deque(maxlen=self.window)
+
+    def record(self, startTime, ok):
+        finishTime = time.time()
+        with self.lock:
+            self.requests += 1
+            if not ok:
+                self.errors += 1
+            self.recent.append((finishTime, finishTime - startTime))
+
+    @staticmethod
+    def percentile(sortedValues, fraction):
+        if not sortedValues:
+            return 0
+        indx = min(len(sortedValues) - 1, int(fraction * len(sortedValues)))
+        return sortedValues[indx]
+
+    def summary(self):
+        now = time.time()
+        with self.lock:
+            recent = list(self.recent)
+            (requests, errors) = (self.requests, self.errors)
+
+        latencies = sorted([latency for (_, latency) in recent])
+        recentCount = sum([1 for (finishTime, _) in recent
+                           if finishTime >= now - self.rateSeconds])
+        return {
+            "uptime_s" : round(now - self.startTime, 3),
+            "requests" : requests,
+            "errors" : errors,
+            "requests_per_sec" : round(recentCount / self.rateSeconds, 3),
+            "latency_p50_ms" : round(1000 * self.percentile(latencies, 0.50), 3),
+            "latency_p99_ms" : round(1000 * self.percentile(latencies, 0.99), 3),
+        }
+
+def makeHandler(executor, stats, renderFunc):
+    class RenderHandler(BaseHTTPRequestHandler):
+        maxBodyBytes = 16 * 1024 * 1024
+
+        def respond(self, status, contentType, body):
+            self.send_response(status)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def respondText(self, status, message):
+            self.respond(status, "text/plain; charset=utf-8", message.encode("utf-8"))
+
+        def do_GET(self):
+            if self.path != "/stats":
+                self.respondText(404, "Expected GET /stats or POST /render")
+                return
+            body = json.dumps(stats.summary(), indent=2).encode("utf-8")
+            self.respond(200, "application/json", body)
+
+        def do_POST(self):
+            startTime = time.time()
+            if self.path != "/render":
+                self.respondText(404, "Expected GET /stats or POST /render")
+                return
+
+            length = int(self.headers.get("Content-Length", 0))
+            if length > self.maxBodyBytes:
+                self.respondText(413, f"Request body larger than {self.maxBodyBytes} bytes")
+                stats.record(startTime, False)
+                return
+            try:
+                request = json.loads(self.rfile.read(length))
+                (spec, text) = (request["spec"], request["text"])
+                if not isinstance(text, str):
+                    raise TypeError("'text' must be a string")
+            except (ValueError, KeyError, TypeError) as e:
+                self.respondText(400, "Expected a JSON object with 'spec' (a table or " \
+                                 f"TOML string) and 'text' (a string): {e}")
+                stats.record(startTime, False)
+                return
+
+            try:
+                (status, contentType, body) = executor.submit(renderFunc, spec, text).result()
+            except Exception as e:
+                (status, contentType, body) = (500, "text/plain; charset=utf-8",
+                                               f"Internal error: {e!r}".encode("utf-8"))
+            self.respond(status, contentType, body)
+            stats.record(startTime, status == 200)
+
+        def log_message(self, format, *args):
+            # Per-request logging would dominate the cost of load tests
+            pass
+
+    return RenderHandler
+
+def runServer(host, port, jobs, renderFunc, initializer=None):
+    stats = ServerStats()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initializer) as executor:
+        server = ThreadingHTTPServer((host, port),
+                                     makeHandler(executor, stats, renderFunc))
+        Logging.header(f"Serving captions on http://{host}:{server.server_port} with " \
+                       f"{jobs} worker(s) (Ctrl+C to stop)")
+        Logging.subSection("POST /render  {\"spec\": <table or TOML string>, " \
+                           "\"text\": <caption text>}")
+        Logging.subSection("GET  /stats")
+        Logging.divider()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            Logging.header("Server statistics")
+            Logging.table(list(stats.summary().items()))
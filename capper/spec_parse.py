@@ -2,11 +2,19 @@ from functools import partial
 import toml
 from numbers import Number
 from pathlib import Path
+from PIL import Image
 import re
 import sys
 
+from font_index import FontIndex
 from pretty_logging import Logging, UserError
 
+try:
+    # Optional plugin that teaches Pillow to write AVIF images
+    import pillow_avif
+except ImportError:
+    pass
+
 class UserSpec:
     rgbaRe = re.compile("#([0-9A-F][0-9A-F])([0-9A-F][0-9A-F])"
                         "([0-9A-F][0-9A-F])([0-9A-F][0-9A-F])",
@@ -32,11 +40,28 @@ class UserSpec:
                 # later stage in the program after the text has been parsed.
                 internalColl[defaultKey]["value"] = None
 
-    def __init__(self, fileName):
-        Logging.header(f"Verifying specification file '{fileName}'")
-        UserError.uassert( Path(fileName).is_file(), f"File '{fileName}' does not exist" )
-        with open(fileName, "r", encoding="utf-8") as f:
-            spec = toml.load(f)
+    def __init__(self, fileName, spec=None, inlineText=None):
+        # `spec` may be given as an already loaded dictionary (or TOML string) instead
+        # of a file, and `inlineText` as the text itself instead of a path to it. Both
+        # are used to render requests without touching the disk.
+        self.inlineText = inlineText
+        if spec is None:
+            Logging.header(f"Verifying specification file '{fileName}'")
+            UserError.uassert( Path(fileName).is_file(), f"File '{fileName}' does not exist" )
+            with open(fileName, "r", encoding="utf-8") as f:
+                spec = toml.load(f)
+        else:
+            Logging.header(f"Verifying specification '{fileName}'")
+            if isinstance(spec, str):
+                try:
+                    spec = toml.loads(spec)
+                except toml.TomlDecodeError as e:
+                    UserError.uassert(False, f"Invalid TOML in specification: {e}")
+            UserError.uassert(isinstance(spec, dict), "Expected specification to be a " \
+                              f"table, got {type(spec)}")
+            for header in ["image", "text", "output"]:
+                UserError.uassert(isinstance(spec.get(header, {}), dict),
+                                  f"Expected [{header}] to be a table")
 
         Logging.subSection("Checking top level headers...")
         topLevelKeys = ["image", "text", "output", "characters"]
@@ -44,7 +69,7 @@ class UserSpec:
 
         Logging.subSection("Checking [image]...")
         self.image = {}
-        self.imageValidKeys = ["art", "image_height", "bg_color"]
+        self.imageValidKeys = ["art", "image_height", "max_image_height", "bg_color"]
         imageRequiredKeys = ["bg_color"]
         self.checkKeys(spec["image"], self.imageValidKeys, imageRequiredKeys, self.image)
         self.validateAndSetImage(spec["image"])
@@ -52,16 +77,18 @@ class UserSpec:
         Logging.subSection("Checking [text]...")
         self.text = {}
         self.textValidKeys = ["text", "base_font_height", "padding", "line_spacing",
-                              "text_width", "text_box_pos", "alignment", "credits",
-                              "credits_pos"]
-        textRequiredKeys = ["text", "text_box_pos"]
+                              "text_width", "wrap_mode", "text_box_pos", "alignment",
+                              "credits", "credits_pos", "paginate", "page_height"]
+        textRequiredKeys = ["text", "text_box_pos"] if inlineText is None \
+                           else ["text_box_pos"]
         self.checkKeys(spec["text"], self.textValidKeys, textRequiredKeys, self.text)
         self.validateAndSetText(spec["text"])
 
         Logging.subSection("Checking [output]...")
         self.output = {}
         self.outputValidKeys = ["outputs", "output_directory", "output_img_format",
-                                "output_img_quality", "base_filename"]
+                                "output_img_quality", "encode_preset", "strip_height",
+                                "base_filename"]
         outputRequiredKeys = ["base_filename"]
         self.checkKeys(spec["output"], self.outputValidKeys, outputRequiredKeys, self.output)
         self.validateAndSetOutput(spec["output"])
@@ -91,13 +118,21 @@ class UserSpec:
         UserError.uassert(not (imgHeightGiven and txtHeightGiven),
                           f"Cannot specify image_height and base_font_height together")
 
+        UserError.uassert(self.text["paginate"]["value"] or self.text["page_height"]["default"],
+                          "page_height only applies when paginate is true")
+
+        UserError.uassert(self.output["output_img_format"]["value"] == "png" or
+                          self.output["strip_height"]["default"],
+                          "strip_height only applies when output_img_format is 'png'")
+
         artNotGiven = self.image["art"]["default"]
-        if artNotGiven and "caption" in outputs:
-            UserError.uassert(outputs != "caption", "Cannot generate caption without art. " \
-                "Either specify 'art' under [image], or remove 'caption' from list 'outputs'")
+        outputs = self.output["outputs"]["value"]
+        UserError.uassert(not (artNotGiven and "caption" in outputs), "Cannot generate " \
+            "caption without art. Either specify 'art' under [image], or remove " \
+            "'caption' from list 'outputs'")
 
         if artNotGiven and "art" in outputs:
-            UserError.uassert(outputs != "caption", "Cannot generate rescaled art " \
+            UserError.uassert(False, "Cannot generate rescaled art " \
                 "without art. Either specify 'art' under [image], or remove 'art' " \
                 "from list 'outputs'")
 
@@ -148,8 +183,11 @@ class UserSpec:
             if outSpec[key]["default"] == False:
                 outSpec[key]["value"] = checkSpec[key]["check"](inSpec, key)
             else:
+                # Defaults that are expensive to find are given as functions, so that
+                # they're only found when the option isn't set
                 if "default" in checkSpec[key]:
-                    outSpec[key]["value"] = checkSpec[key]["default"]
+                    default = checkSpec[key]["default"]
+                    outSpec[key]["value"] = default() if callable(default) else default
                 else:
                     outSpec[key]["value"] = None
 
@@ -161,6 +199,10 @@ class UserSpec:
             "image_height" : {
                 "check" : partial(UserSpec.checkTypeAndMinVal, int, 0, "gt")
             },
+            "max_image_height" : {
+                "check" : partial(UserSpec.checkTypeAndMinVal, int, 0, "gt"),
+                "default" : 3000
+            },
             "bg_color" : {
                 "check" : UserSpec.checkColor
             }
@@ -177,9 +219,30 @@ class UserSpec:
                     f"Expected line {line} in credits to be {str}, got {type(line)}")
             return capCredits
 
+        def checkBool(coll, key):
+            value = coll[key]
+            UserError.uassert(isinstance(value, bool),
+                f"Expected {key} to be {bool}, got {type(value)}")
+            return value
+
+        def checkTextBoxPos(coll, key):
+            # Either a named layout, or the columns of the caption from left to right
+            textBoxPos = coll[key]
+            if not isinstance(textBoxPos, list):
+                return UserSpec.valueInList(["left", "right", "split"], coll, key)
+            for column in textBoxPos:
+                UserError.uassert(column in ["text", "art"],
+                    f"Invalid column '{column}' in '{key}', expected one of ['text', 'art']")
+            UserError.uassert(textBoxPos.count("art") == 1,
+                f"Expected '{key}' to have exactly one 'art' column, got {textBoxPos}")
+            UserError.uassert("text" in textBoxPos,
+                f"Expected '{key}' to have at least one 'text' column, got {textBoxPos}")
+            return textBoxPos
+
         checkText = {
             "text" : {
-                "check" : UserSpec.checkFile
+                "check" : UserSpec.checkFile if self.inlineText is None
+                          else lambda coll, key : None
             },
             "base_font_height" : {
                 "check" : partial(UserSpec.checkTypeAndMinVal, int, 0, "gt"),
@@ -196,8 +259,12 @@ class UserSpec:
             "text_width" : {
                 "check" : partial(UserSpec.checkTypeAndMinVal, Number, 0, "gt"),
             },
+            "wrap_mode" : {
+                "check" : partial(UserSpec.valueInList, ["greedy", "optimal"]),
+                "default" : "greedy"
+            },
             "text_box_pos" : {
-                "check" : partial(UserSpec.valueInList, ["left", "right", "split"])
+                "check" : checkTextBoxPos
             },
             "alignment" : {
                 "check" : partial(UserSpec.valueInList, ["left", "right", "center"]),
@@ -210,6 +277,13 @@ class UserSpec:
             "credits_pos" : {
                 "check" : partial(UserSpec.valueInList, ["tl", "tr", "bl", "br"]),
                 "default" : "tl"
+            },
+            "paginate" : {
+                "check" : checkBool,
+                "default" : False
+            },
+            "page_height" : {
+                "check" : partial(UserSpec.checkTypeAndMinVal, int, 0, "gt"),
             }
         }
         UserSpec.validateAndFillSpec(inText, self.text, checkText)
@@ -241,6 +315,18 @@ class UserSpec:
                                   f"contain one of {outputTypes}, got '{output}'")
             return outputs
 
+        def checkImgFormat(coll, key):
+            imgFormat = UserSpec.valueInList(["png", "jpg", "jpeg", "webp", "avif"],
+                                             coll, key)
+            pilFormat = Image.registered_extensions().get("." + imgFormat)
+            if imgFormat == "avif":
+                UserError.uassert(pilFormat in Image.SAVE, "Writing AVIF images " \
+                    "requires the 'pillow-avif-plugin' package. Install it with " \
+                    "'pip install pillow-avif-plugin', or pick another output_img_format")
+            UserError.uassert(pilFormat in Image.SAVE, f"This installation of Pillow " \
+                f"cannot write '{imgFormat}' images, pick another output_img_format")
+            return imgFormat
+
         checkOutput = {
             "outputs" : {
                 "check" : checkOutputs,
@@ -251,13 +337,20 @@ class UserSpec:
                 "default" : ""
             },
             "output_img_format" : {
-                "check" : partial(UserSpec.valueInList, ["png", "jpg", "jpeg"]),
+                "check" : checkImgFormat,
                 "default" : "png"
             },
             "output_img_quality" : {
                 "check" : partial(valueIsIntInRange, 0, 100),
                 "default" : 100
             },
+            "encode_preset" : {
+                "check" : partial(UserSpec.valueInList, ["fast", "balanced", "smallest"]),
+                "default" : "smallest"
+            },
+            "strip_height" : {
+                "check" : partial(UserSpec.checkTypeAndMinVal, int, 0, "gt"),
+            },
             "base_filename" : {
                 "check" : lambda coll, key : str(coll[key]),
             }
@@ -273,14 +366,6 @@ class UserSpec:
                     f"Special character '{char}' not allowed in name '{name}'")
             return name
 
-        def findFontFromDefault(default, fileSuffix):
-            parentDir = Path(default).parent
-            for f in parentDir.rglob("*"):
-                fileName = f.as_posix()
-                if fileName.lower()[len(fileName)-len(fileSuffix):] == fileSuffix.lower():
-                    return fileName
-            return default
-
         checkChar = {
             "name" : {
                 "check" : verifyNoSpecialChars
@@ -305,37 +390,38 @@ class UserSpec:
             },
             "font_bold" : {
                 "check" : UserSpec.checkFile,
-                "default" : findFontFromDefault(inChar["font"], "-Bold.ttf")
+                "default" : partial(FontIndex.findVariant, inChar["font"], "-Bold.ttf")
             },
             "font_italic" : {
                 "check" : UserSpec.checkFile,
-                "default" : findFontFromDefault(inChar["font"], "-Italic.ttf")
+                "default" : partial(FontIndex.findVariant, inChar["font"], "-Italic.ttf")
             },
             "font_bolditalic" : {
                 "check" : UserSpec.checkFile,
-                "default" : findFontFromDefault(inChar["font"], "-BoldItalic.ttf")
+                "default" : partial(FontIndex.findVariant, inChar["font"], "-BoldItalic.ttf")
             }
         }
         UserSpec.validateAndFillSpec(inChar, storedChar, checkChar)
 
     def outputFilledSpec(self, specFilename=None):
+        def valueStr(value):
+            if isinstance(value, str):
+                return f"\"{value}\""
+            elif isinstance(value, bool):
+                return str(value).lower()
+            elif isinstance(value, float):
+                return f"{value:.3f}"
+            return f"{value}"
+
         def writeSection(f, data, orderedKeys):
+            # Options without a value (e.g. page_height without pagination) have
+            # nothing to show
             for key in orderedKeys:
                 if data[key]["default"] == False:
-                    if isinstance(data[key]["value"], str):
-                        f.write(f"{key} = \"{data[key]['value']}\"\n")
-                    elif isinstance(data[key]["value"], float):
-                        f.write(f"{key} = {data[key]['value']:.3f}\n")
-                    else:
-                        f.write(f"{key} = {data[key]['value']}\n")
+                    f.write(f"{key} = {valueStr(data[key]['value'])}\n")
             for key in orderedKeys:
-                if data[key]["default"] == True:
-                    if isinstance(data[key]["value"], str):
-                        f.write(f"# {key} = \"{data[key]['value']}\"\n")
-                    elif isinstance(data[key]["value"], float):
-                        f.write(f"# {key} = {data[key]['value']:.3f}\n")
-                    else:
-                        f.write(f"# {key} = {data[key]['value']}\n")
+                if data[key]["default"] == True and data[key]["value"] is not None:
+                    f.write(f"# {key} = {valueStr(data[key]['value'])}\n")
 
         f = sys.stdout if specFilename is None else open(specFilename, "w")
         f.write("[image]\n")
@@ -0,0 +1,216 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import copy
+import itertools
+from math import ceil
+import time
+import toml
+from PIL import Image, ImageDraw
+
+from fonts import FaceCache
+from pretty_logging import Logging, UserError
+from profiling import Profiler
+from render import Renderer
+from spec_parse import UserSpec
+from text import LineCache
+
+# [text] options that may list several values to sweep over
+SWEEP_KEYS = ["base_font_height", "padding", "line_spacing", "text_width"]
+# Height of each caption on the contact sheet
+THUMB_HEIGHT = 360
+
+def sweepVariants(specFile):
+    # Returns ({option : values}, [(label, spec)]) for every combination of the
+    # listed values, validating every variant before anything is rendered
+    with open(specFile, "r", encoding="utf-8") as f:
+        try:
+            rawSpec = toml.load(f)
+        except toml.TomlDecodeError as e:
+            UserError.uassert(False, f"Invalid TOML in specification: {e}")
+    textSpec = rawSpec.get("text", {})
+    UserError.uassert(isinstance(textSpec, dict), "Expected [text] to be a table")
+    sweeps = {key : textSpec[key] for key in SWEEP_KEYS
+              if isinstance(textSpec.get(key), list)}
+    UserError.uassert(sweeps != {}, "Nothing to sweep, expected a list of values for " \
+                      f"at least one of {SWEEP_KEYS} under [text]")
+    for (key, values) in sweeps.items():
+        UserError.uassert(values != [], f"Expected at least one value to sweep '{key}' over")
+    UserError.uassert(not textSpec.get("paginate", False),
+                      "--sweep cannot be combined with paginate")
+
+    variants = []
+    Logging.quiet = True
+    try:
+        for values in itertools.product(*sweeps.values()):
+            variantSpec = copy.deepcopy(rawSpec)
+            variantSpec["text"].update(zip(sweeps.keys(), values))
+            label = "  ".join([f"{key}={value}" for (key, value) in zip(sweeps, values)])
+            try:
+                with Profiler.stage("Spec validation"):
+                    spec = UserSpec(specFile, spec=variantSpec)
+            except UserError as e:
+                raise UserError(f"Invalid variant '{label}': {e.message}")
+            variants.append((label, spec))
+    finally:
+        Logging.quiet = False
+    UserError.uassert(variants[0][1].image["art"]["value"] is not None,
+                      "Sweeping requires 'art' under [image]")
+    return (sweeps, variants)
+
+@Profiler.timed("Contact sheet")
+def contactSheet(thumbs, labels, renderer):
+    # Lays the thumbnails out in a grid, each labeled with its variant number and
+    # parameter values in the first character's font and color
+    charSpec = renderer.spec.characters[0]
+    font = renderer.fonts[charSpec["name"]["value"]]["font"]
+    labelHeight = max(12, THUMB_HEIGHT // 20)
+    face = FaceCache.get(font.path, labelHeight)
+    margin = labelHeight
+
+    columns = ceil(len(thumbs) ** 0.5)
+    rows = ceil(len(thumbs) / columns)
+    cellWidth = max([thumb.width for thumb in thumbs]) + margin
+    cellHeight = THUMB_HEIGHT + (2 * labelHeight) + margin
+    sheet = Image.new(renderer.colorMode(), (margin + (columns * cellWidth),
+                      margin + (rows * cellHeight)), renderer.bgColor())
+    d = ImageDraw.Draw(sheet)
+    for (i, (thumb, (number, label))) in enumerate(zip(thumbs, labels)):
+        (x, y) = (margin + (i % columns) * cellWidth, margin + (i // columns) * cellHeight)
+        sheet.paste(thumb, (x, y))
+        d.text((x, y + THUMB_HEIGHT + (labelHeight // 2)), f"{number:02}: {label}",
+               font=face, fill=font.rgba)
+    return sheet
+
+# Renderer of a sweep worker process. Its fonts, parsed text, and scaled art are
+# kept for every variant the worker renders.
+SWEEP_RENDERER = None
+
+def initSweepWorker(spec):
+    global SWEEP_RENDERER
+    Logging.quiet = True
+    SWEEP_RENDERER = Renderer(spec)
+    with Profiler.stage("Parsing"):
+        SWEEP_RENDERER.paragraphs.parse(spec.inlineText)
+
+def sweepWorker(imgFile, spec):
+    # Lays out, draws, and writes one variant. Returns (error, (dimensions, size,
+    # duration, thumbnail, stage timings, line cache statistics)), where the error
+    # is (exception type, message), since a UserError can't be sent back as one.
+    startTime = time.time()
+    result = None
+    try:
+        renderer = SWEEP_RENDERER.withSpec(spec)
+        (textBoxes, art) = renderer.layout()
+        img = renderer.drawCaption(textBoxes, art)
+        with Profiler.stage("Contact sheet"):
+            thumb = img.resize((max(1, round(img.width * THUMB_HEIGHT / img.height)),
+                                THUMB_HEIGHT), Image.Resampling.BILINEAR,
+                               reducing_gap=2.0)
+        with Profiler.stage("Encoding _sweep"):
+            data = renderer.encode(img)
+        with Profiler.stage("Writing outputs"), open(imgFile, "wb") as f:
+            f.write(data)
+        result = (Logging.dimensionsStr(img), Logging.sizeStr(len(data)),
+                  time.time() - startTime, thumb, Profiler.snapshot(), LineCache.stats())
+        error = None
+    except UserError as e:
+        error = ("UserError", e.message)
+    except Exception as e:
+        # Anything else would otherwise lose every variant rendered so far
+        error = (type(e).__name__, str(e))
+    # The next variant reports only its own timings
+    Profiler.clear()
+    LineCache.resetStats()
+    return (error, result)
+
+def logErrors(errors, variants):
+    for (i, (errorType, message)) in sorted(errors.items()):
+        Logging.subSection(f"{errorType} in variant {i + 1:02} ({variants[i][0]}): " \
+                           f"{message}", 1, "red")
+
+def runSweep(specFile, jobs):
+    # Returns (contact sheet file, line cache statistics of every worker). Variants
+    # that fail are listed in the summary and left off the contact sheet.
+    Logging.header(f"Sweeping specification file '{specFile}'")
+    (sweeps, variants) = sweepVariants(specFile)
+    for (key, values) in sweeps.items():
+        Logging.subSection(f"{key}: {values}")
+    Logging.subSection(f"{len(variants)} variants on {jobs} worker(s)")
+
+    spec = variants[0][1]
+    directory = spec.output["output_directory"]["value"]
+    if directory != "" and directory[-1] != "/" and directory[-1] != "\\":
+        directory += "/"
+    baseFilename = directory + spec.output["base_filename"]["value"]
+    outputFmt = spec.output["output_img_format"]["value"]
+    # The text is read once and sent to the workers with every variant
+    with open(spec.text["text"]["value"], "r", encoding="utf-8") as f:
+        text = f.read()
+    for (_, variantSpec) in variants:
+        variantSpec.inlineText = text
+
+    # Every variant is rendered start to finish by one of the worker processes,
+    # which each load the fonts and parse the text once, up front
+    results = {}
+    errors = {}
+    lineStats = LineCache.stats()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initSweepWorker,
+                             initargs=(spec,)) as executor:
+        futures = {executor.submit(sweepWorker, f"{baseFilename}_sweep_{i + 1:02}." \
+                                   f"{outputFmt}", variantSpec) : i
+                   for (i, (_, variantSpec)) in enumerate(variants)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                (error, result) = future.result()
+            except Exception as e:
+                # e.g. the worker was killed, which fails every variant still pending
+                (error, result) = ((type(e).__name__, str(e)), None)
+            if error is not None:
+                errors[i] = error
+                Logging.subSection(f"Failed to render variant {i + 1:02} " \
+                                   f"({variants[i][0]})", 1, "red")
+                continue
+            results[i] = result
+            Profiler.add(result[4])
+            lineStats = LineCache.combineStats(lineStats, result[5])
+            Logging.subSection(f"Rendered variant {i + 1:02} ({variants[i][0]}) in " \
+                               f"{result[2]:.2f}s")
+
+    rendered = sorted(results)
+    if not rendered:
+        logErrors(errors, variants)
+        raise UserError("Every variant failed to render")
+
+    Logging.header("Generating contact sheet")
+    startTime = time.time()
+    # Only draws and encodes the contact sheet, so it never lays anything out
+    renderer = Renderer(spec)
+    renderer.spec = spec
+    sheetFile = f"{baseFilename}_sweep.{outputFmt}"
+    sheet = contactSheet([results[i][3] for i in rendered],
+                         [(i + 1, variants[i][0]) for i in rendered], renderer)
+    with Profiler.stage("Encoding _sweep"):
+        data = renderer.encode(sheet)
+    with Profiler.stage("Writing outputs"), open(sheetFile, "wb") as f:
+        f.write(data)
+
+    table = [("File", "Variant", "Size", "Dimensions", "Time")]
+    for (i, (label, _)) in enumerate(variants):
+        if i in errors:
+            table.append((f"{baseFilename}_sweep_{i + 1:02}.{outputFmt}", label,
+                          "FAILED", "", ""))
+            continue
+        (dimensions, size, duration, _, _, _) = results[i]
+        table.append((f"{baseFilename}_sweep_{i + 1:02}.{outputFmt}", label, size,
+                      dimensions, f"{duration:.2f}s"))
+    table.append((sheetFile, "contact sheet", Logging.sizeStr(len(data)),
+                  Logging.dimensionsStr(sheet), f"{time.time() - startTime:.2f}s"))
+    if errors:
+        Logging.table(table)
+        logErrors(errors, variants)
+        Logging.subSection(f"{len(rendered)} of {len(variants)} variants rendered " \
+                           "successfully", 1, "red")
+    else:
+        Logging.subSection("Successfully generated all images!", 1, "green")
+        Logging.table(table)
+    return (sheetFile, lineStats)
@@ -1,29 +1,50 @@
-from math import ceil
+from bisect import bisect_left, bisect_right
+from collections import deque, OrderedDict
+import copy
+from math import ceil, floor, modf
+import re
+import threading
+from PIL import Image, ImageDraw
 
 from pretty_logging import Logging, UserError
 
 class FmtUnit:
-    def __init__(self, txt, font):
+    def __init__(self, txt, font, units=None):
         self.txt = txt
         self.font = font
+        # Length per pixel of font height, so resizing the font doesn't re-measure
+        self.units = font.units(txt) if units is None else units
         self.length = 0
         self.setLength()
 
     def setLength(self):
-        self.length = self.font.getLength(self.txt)
+        self.length = self.units * self.font.height
 
-    def drawUnit(self, d, x, y):
-        d.text((x, y), self.txt, anchor="ls", **self.font.imgDrawKwargs())
+    def measure(self):
+        # Exact length at the current font height, for drawing
+        self.length = self.font.getLength(self.txt)
 
 class FmtWord:
-    def __init__(self, fmtUnits, maxHeight=None):
+    def __init__(self, fmtUnits, newlineFont=None):
         self.fmtUnits = fmtUnits
-        self._maxHeight = maxHeight
+        # Newlines have no units, so they remember the font that was active when they
+        # were entered to know how far to move the cursor.
+        self.newlineFont = newlineFont
+        self.spaceLength = 0
+        self.computeLength()
 
+    def computeLength(self):
+        self._maxHeight = None
         self.actualLength = 0
-        for unit in fmtUnits:
+        for unit in self.fmtUnits:
             self.actualLength += unit.length
-        self.spaceLength = 0
+
+    def remeasure(self):
+        # Called after the fonts of this word were resized. Lengths scale with the
+        # font height, so this is a multiply per unit.
+        for unit in self.fmtUnits:
+            unit.setLength()
+        self.computeLength()
 
     def isNewline(self):
         return self.fmtUnits == []
@@ -32,182 +53,285 @@ class FmtWord:
         if self._maxHeight is not None:
            return self._maxHeight
 
+        if self.isNewline():
+            self._maxHeight = self.newlineFont.height
+            return self._maxHeight
+
         self._maxHeight = 0
         for unit in self.fmtUnits:
             self._maxHeight = max(unit.font.height, self._maxHeight)
         return self._maxHeight
 
-def gatherPeople(text, lBraces, rBraces, validPeople):
+# A special character is escaped if and only if it directly follows a backslash.
+specialCharRe = re.compile(r"(?<!\\)[\[\]*_\n ]")
+lBraceRe = re.compile(r"(?<!\\)\[")
+newlineRe = re.compile(r"(?<!\\)\n")
+escapedCharRe = re.compile(r"\\([\[\]*_\n ])")
+
+def braceWindow(text, indx):
     strRange = 10
-    (lBraces, rBraces) = (list(lBraces), list(rBraces))
-    people = []
-
-    while lBraces or rBraces:
-        if not lBraces:
-            val = rBraces[0]
-            strWindow = text[max(0,val-strRange):val+strRange]
-            UserError.uassert(
-                False, f"Unmatched ']' around \n'''\n...{strWindow}...\n'''")
-        if not rBraces:
-            val = lBraces[0]
-            strWindow = text[max(0,val-strRange):val+strRange]
-            UserError.uassert(
-                False, f"Unmatched '[' around \n'''\n...{strWindow}...\n'''")
-
-        (currL, currR) = (lBraces.pop(0), rBraces.pop(0))
-        if currL > currR:
-            valR = currR
-            strWindowR = text[max(0,valR-strRange):valR+strRange]
-            valL = currL
-            strWindowL = text[max(0,valL-strRange):valL+strRange]
-            UserError.uassert(
-                False, f"']' around \n'''\n...{strWindowR}...\n'''\n appeared before " \
-                f"'[' around \n'''\n...{strWindowL}...\n'''")
-
-        person = text[currL+1:currR]
-        UserError.uassert(person in validPeople, f"Unexpected character '{person}' " \
-                          f"in text file, expected one of {validPeople}")
-        people.append(person)
-    return people
+    return text[max(0,indx-strRange):indx+strRange]
+
+def unmatchedRBrace(text, rIndx):
+    # Every '[' before this ']' has already been paired, so the '[' that should pair
+    # with it can only come later in the text (if it exists at all).
+    nextL = lBraceRe.search(text, rIndx + 1)
+    if nextL is None:
+        UserError.uassert(
+            False, f"Unmatched ']' around \n'''\n...{braceWindow(text, rIndx)}...\n'''")
+    UserError.uassert(
+        False, f"']' around \n'''\n...{braceWindow(text, rIndx)}...\n'''\n appeared " \
+        f"before '[' around \n'''\n...{braceWindow(text, nextL.start())}...\n'''")
+
+class Tokenizer:
+    def __init__(self, fonts, person):
+        self.fonts = fonts
+        self.validPeople = list(fonts.keys())
+        (self.person, self.bold, self.italic) = (person, False, False)
+
+    def state(self):
+        return (self.person, self.bold, self.italic)
+
+    def setState(self, state):
+        (self.person, self.bold, self.italic) = state
+
+    def selectFont(self):
+        if self.bold and self.italic:
+            return self.fonts[self.person]["font_bolditalic"]
+        elif self.bold:
+            return self.fonts[self.person]["font_bold"]
+        elif self.italic:
+            return self.fonts[self.person]["font_italic"]
+        return self.fonts[self.person]["font"]
+
+    def tokenize(self, text):
+        font = self.selectFont()
+        fmtUnits = []
+        startIndx = 0
+        lBraces = deque()
+
+        # Walk the special characters once, in order. Text between two special
+        # characters is a contiguous region with unique formatting.
+        for match in specialCharRe.finditer(text):
+            currIndx = match.start()
+            currChar = match.group()
+
+            # Inside a character specifier. Nothing is emitted until the closing brace.
+            if lBraces:
+                if currChar == "[":
+                    lBraces.append(currIndx)
+                elif currChar == "]":
+                    currL = lBraces.popleft()
+                    person = text[currL+1:currIndx]
+                    UserError.uassert(person in self.validPeople, "Unexpected character " \
+                        f"'{person}' in text file, expected one of {self.validPeople}")
+                    self.person = person
+                    font = self.selectFont()
+                    startIndx = currIndx + 1
+                continue
+
+            if currChar == "]":
+                unmatchedRBrace(text, currIndx)
+
+            currRegionText = text[startIndx:currIndx]
+            if currRegionText != "":
+                if "\\" in currRegionText:
+                    currRegionText = escapedCharRe.sub(r"\1", currRegionText)
+                fmtUnits.append(FmtUnit(currRegionText, font))
+            startIndx = currIndx + 1
 
-def parseText(text, fonts, firstChar):
-    class FmtState:
-        def __init__(self, font, bold, italic, person):
-            self.font = font
-            self.bold = bold
-            self.italic = italic
-            self.person = person
-            self.startIndx = 0
-
-            self.fmtWords = []
-            self.fmtUnits = []
-
-        def updateState(self, currChar, currIndx, specialColl, text):
             if currChar == "[":
-                self.updatePerson(specialColl["["], text)
+                lBraces.append(currIndx)
             elif currChar == "*":
-                self.toggleBold(currIndx)
+                self.bold = not self.bold
+                font = self.selectFont()
             elif currChar == "_":
-                self.toggleItalic(currIndx)
+                self.italic = not self.italic
+                font = self.selectFont()
             elif currChar == "\n":
-                self.updateNewline(currIndx)
+                if fmtUnits:
+                    yield FmtWord(fmtUnits)
+                    fmtUnits = []
+                yield FmtWord([], font)
             elif currChar == " ":
-                self.updateSpace(currIndx)
-            else:
-                assert False, f"`updateState()` called with invalid char '{currChar}'"
-
-        def setFont(self):
-            if self.bold and self.italic:
-                self.font = fonts[self.person]["font_bolditalic"]
-            elif self.bold:
-                self.font = fonts[self.person]["font_bold"]
-            elif self.italic:
-                self.font = fonts[self.person]["font_italic"]
-            else:
-                self.font = fonts[self.person]["font"]
-
-        def updatePerson(self, lBraceDict, text):
-            i = lBraceDict["end_indices"].pop(0) + 1
-            for char in text[i:]:
-                if char == " " or char == "\n":
-                    i += 1
-                else:
-                    break
-            self.startIndx = i
-            self.person = lBraceDict["people"].pop(0)
-            self.setFont()
-
-        def toggleBold(self, currIndx):
-            self.startIndx = currIndx + 1
-            self.bold = not self.bold
-            self.setFont()
-
-        def toggleItalic(self, currIndx):
-            self.startIndx = currIndx + 1
-            self.italic = not self.italic
-            self.setFont()
-
-        def updateNewline(self, currIndx):
-            if self.fmtUnits:
-                self.fmtWords.append(FmtWord(self.fmtUnits))
-                self.fmtUnits = []
-
-            self.fmtWords.append(FmtWord([], self.font.height))
-            self.startIndx = currIndx + 1
-
-        def updateSpace(self, currIndx):
-            if self.fmtUnits:
-                self.fmtWords.append(FmtWord(self.fmtUnits))
-                self.fmtUnits = []
-
-            self.startIndx = currIndx + 1
-
-    Logging.subSection(f"Parsing text file")
-    specialChars = {
-        "["  : {
-            "indices" : [],
-            "end_indices": [],
-            "people" : [],
-        },
-        "]"  : { "indices" : [] },
-        "*"  : { "indices" : [] },
-        "_"  : { "indices" : [] },
-        "\n" : { "indices" : [] },
-        " "  : { "indices" : [] }
-    }
-    originalSpecialChars = list(specialChars.keys())
-
-    lastCharSlash = False
-    # Collect all braces/asterisks/underscores. Prune out the markers preceded by a '\'
-    for i, char in enumerate(text):
-        if char in specialChars and not lastCharSlash:
-            specialChars[char]["indices"].append(i)
-        else:
-            lastCharSlash = (char == "\\")
-
-    # Assert that people specifers are valid and collect people
-    specialChars["["]["people"] = gatherPeople(
-        text, specialChars["["]["indices"], specialChars["]"]["indices"],
-        list(fonts.keys()))
-
-    specialChars["["]["end_indices"] = specialChars["]"]["indices"]
-    del specialChars["]"]
-
-    # Block out contiguous regions of text with unique formatting. Prune whitespace
-    # immediately after character specifier.
-    fmtState = FmtState(fonts[firstChar]["font"], False, False, firstChar)
-    while True:
-        endIndx = float('inf')
-        empty = 0
-        for char in specialChars:
-            if not specialChars[char]["indices"]:
-                empty += 1
-                continue
-            if specialChars[char]["indices"][0] < endIndx:
-                nxtSpecialChar = char
-                endIndx = specialChars[char]["indices"][0]
-        if empty == len(specialChars):
-            break
-
-        specialChars[nxtSpecialChar]["indices"].pop(0)
+                if fmtUnits:
+                    yield FmtWord(fmtUnits)
+                    fmtUnits = []
 
-        currRegionText = text[fmtState.startIndx : endIndx]
-
-        for specialChar in originalSpecialChars:
-            currRegionText = currRegionText.replace(f"\\{specialChar}", specialChar)
+        if lBraces:
+            UserError.uassert(False, "Unmatched '[' around \n'''\n..." \
+                              f"{braceWindow(text, lBraces[0])}...\n'''")
 
+        currRegionText = text[startIndx:]
         if currRegionText != "":
-            fmtState.fmtUnits.append(FmtUnit(currRegionText, fmtState.font))
-
-        fmtState.updateState(
-            nxtSpecialChar, endIndx, specialChars, text)
+            fmtUnits.append(FmtUnit(currRegionText, font))
+            yield FmtWord(fmtUnits)
 
-    currRegionText = text[fmtState.startIndx:]
-    if currRegionText != "":
-        fmtState.fmtUnits.append(FmtUnit(currRegionText, fmtState.font))
-        fmtState.fmtWords.append(FmtWord(fmtState.fmtUnits))
+def tokenizeText(text, fonts, firstChar):
+    return Tokenizer(fonts, firstChar).tokenize(text)
 
-    return fmtState.fmtWords
+def parseText(text, fonts, firstChar):
+    Logging.subSection(f"Parsing text file")
+    return list(tokenizeText(text, fonts, firstChar))
+
+def splitParagraphs(text):
+    paragraphs = []
+    startIndx = 0
+    for match in newlineRe.finditer(text):
+        paragraphs.append(text[startIndx:match.end()])
+        startIndx = match.end()
+    paragraphs.append(text[startIndx:])
+    return paragraphs
+
+# Remembers the words parsed from each paragraph (text up to and including an unescaped
+# newline) so that re-parsing an edited text file only tokenizes the paragraphs that
+# changed. A paragraph's words depend on the character and bold/italic state it
+# starts in, so that state is part of the key.
+class ParagraphCache:
+    def __init__(self, fonts, firstChar):
+        self.fonts = fonts
+        self.firstChar = firstChar
+        self.entries = {}
+        self.reparsed = 0
+
+    def parse(self, text):
+        Logging.subSection(f"Parsing text file")
+        tokenizer = Tokenizer(self.fonts, self.firstChar)
+        entries = {}
+        fmtWords = []
+        self.reparsed = 0
+        try:
+            for paragraph in splitParagraphs(text):
+                key = (paragraph,) + tokenizer.state()
+                # Words are mutated while wrapping, so a paragraph repeated in the same
+                # text must get its own words.
+                if key in self.entries and key not in entries:
+                    (words, endState) = self.entries[key]
+                    tokenizer.setState(endState)
+                else:
+                    words = list(tokenizer.tokenize(paragraph))
+                    self.reparsed += 1
+                entries[key] = (words, tokenizer.state())
+                fmtWords += words
+        except UserError:
+            # Errors in a single paragraph can't see the rest of the text. Parse the
+            # whole file to report the same error a normal run would.
+            self.entries = {}
+            return list(tokenizeText(text, self.fonts, self.firstChar))
+
+        self.entries = entries
+        return fmtWords
+
+# Process-wide, bounded LRU cache of rasterized lines. A line is cached as a coverage
+# mask for each of its units (its stroke, then its fill), drawn by `ImageDraw.text()`
+# at the same subpixel position, along with where to ink them. Lines are keyed on
+# their text, fonts, sizes, colors, strokes, spacing, and subpixel position, so a line
+# that's laid out the same way in a later render (in --watch, --sweep, or the next
+# specification of a batch) is never rasterized again.
+class LineCache:
+    maxBytes = 64 << 20
+    lines = OrderedDict()
+    bytes = 0
+    hits = 0
+    misses = 0
+    lock = threading.Lock()
+
+    @staticmethod
+    def key(fmtLine, d, x, y):
+        units = tuple([(unit.txt, unit.font.path, unit.font.height, unit.font.rgba,
+                        unit.font.stroke, unit.font.strokeRgba)
+                       for unit in fmtLine.accumUnits])
+        return (units, tuple(fmtLine.spaceLens), d.fontmode, modf(x)[0], modf(y)[0])
+
+    @staticmethod
+    def rasterize(fmtLine, d, x, y):
+        # Returns ([(unit index, stroked, offset from (int(x), int(y)), mask)] in the
+        # order `ImageDraw.text()` draws them, bytes the masks take up). Every mask is
+        # a blank "L" image the unit was drawn onto in white, with two pixels to spare
+        # around its bounding box for the subpixel position.
+        masks = []
+        size = 0
+        unitX = x
+        for (i, (spaceLen, unit)) in enumerate(zip(fmtLine.spaceLens, fmtLine.accumUnits)):
+            (left, top, right, bottom) = unit.font.font.getbbox(
+                unit.txt, anchor="ls", stroke_width=unit.font.stroke)
+            (originX, originY) = (2 - floor(left), 2 - floor(top))
+            maskSize = (ceil(right) - floor(left) + 4, ceil(bottom) - floor(top) + 4)
+            for stroked in ([True, False] if unit.font.stroke else [False]):
+                mask = Image.new("L", maskSize, 0)
+                maskDraw = ImageDraw.Draw(mask)
+                maskDraw.fontmode = d.fontmode
+                # The stroke's mask also covers the fill, which is drawn over it
+                maskDraw.text((originX + modf(unitX)[0], originY + modf(y)[0]), unit.txt,
+                              fill=255, font=unit.font.font, anchor="ls",
+                              stroke_width=unit.font.stroke if stroked else 0)
+                masks.append((i, stroked, (int(unitX) - int(x) - originX, -originY),
+                              mask))
+                size += maskSize[0] * maskSize[1]
+            unitX += unit.length + spaceLen
+        return (masks, size)
+
+    @staticmethod
+    def get(fmtLine, d, x, y):
+        # Blank lines draw nothing, so they're neither cached nor counted
+        if not fmtLine.accumUnits:
+            return []
+        key = LineCache.key(fmtLine, d, x, y)
+        with LineCache.lock:
+            entry = LineCache.lines.get(key)
+            if entry is not None:
+                LineCache.lines.move_to_end(key)
+                LineCache.hits += 1
+                return entry[0]
+
+        entry = LineCache.rasterize(fmtLine, d, x, y)
+        with LineCache.lock:
+            LineCache.misses += 1
+            if key not in LineCache.lines and entry[1] <= LineCache.maxBytes:
+                LineCache.lines[key] = entry
+                LineCache.bytes += entry[1]
+                while LineCache.bytes > LineCache.maxBytes:
+                    (_, (_, size)) = LineCache.lines.popitem(last=False)
+                    LineCache.bytes -= size
+        return entry[0]
+
+    @staticmethod
+    def stats():
+        with LineCache.lock:
+            return {"hits" : LineCache.hits, "misses" : LineCache.misses,
+                    "lines" : len(LineCache.lines), "bytes" : LineCache.bytes}
+
+    @staticmethod
+    def combineStats(stats, other):
+        # Statistics of two processes' caches, e.g. of batch workers. Lookups add up,
+        # while the size is that of the larger cache.
+        combined = {key : stats[key] + other[key] for key in ["hits", "misses"]}
+        combined.update({key : max(stats[key], other[key]) for key in ["lines", "bytes"]})
+        return combined
+
+    @staticmethod
+    def statsTable(stats=None):
+        stats = LineCache.stats() if stats is None else stats
+        lookups = stats["hits"] + stats["misses"]
+        hitRate = f"{100 * stats['hits'] / lookups:.1f}%" if lookups else "-"
+        return [("Line Cache", "Hits", "Misses", "Hit Rate", "Cached Lines", "Memory"),
+                ("Rasterized lines", stats["hits"], stats["misses"], hitRate,
+                 stats["lines"], Logging.sizeStr(stats["bytes"]))]
+
+    @staticmethod
+    def resetStats():
+        # Counts lookups from here on. Cached lines are kept.
+        with LineCache.lock:
+            LineCache.hits = 0
+            LineCache.misses = 0
+
+    @staticmethod
+    def clear():
+        with LineCache.lock:
+            LineCache.lines = OrderedDict()
+            LineCache.bytes = 0
+            LineCache.hits = 0
+            LineCache.misses = 0
 
 class FormattedLine:
     def __init__(self, fmtWords, maxHeight):
@@ -215,12 +339,15 @@ class FormattedLine:
         self.accumUnits = []
         self.spaceLens = []
         self.length = 0
+        self._extent = None
 
         if not fmtWords:
             return
 
         currFont = fmtWords[0].fmtUnits[0].font
         currTxt = ""
+        # Merged units add up the lengths of their parts rather than being measured
+        currUnits = 0
 
         # Accumulate contiguous FmtUnits which are formatted in the same way into a
         # a single FmtUnit. Rendering the space between words (especially on Windows)
@@ -231,51 +358,82 @@ class FormattedLine:
             if firstUnit.font == currFont:
                 if currTxt != "":
                     currTxt += " "
+                    currUnits += currFont.spaceUnits
                 currTxt += firstUnit.txt
+                currUnits += firstUnit.units
             else:
-                tmpUnit = FmtUnit(currTxt, currFont)
+                tmpUnit = FmtUnit(currTxt, currFont, currUnits)
                 self.accumUnits.append(tmpUnit)
                 self.spaceLens.append(word.spaceLength)
 
                 currTxt = firstUnit.txt
+                currUnits = firstUnit.units
                 currFont = firstUnit.font
 
             for unit in word.fmtUnits[1:]:
                 if unit.font == currFont:
                     currTxt += unit.txt
+                    currUnits += unit.units
                 else:
-                    tmpUnit = FmtUnit(currTxt, currFont)
+                    tmpUnit = FmtUnit(currTxt, currFont, currUnits)
                     self.accumUnits.append(tmpUnit)
                     self.spaceLens.append(0)
 
                     currTxt = unit.txt
+                    currUnits = unit.units
                     currFont = unit.font
         if currTxt != "":
-            tmpUnit = FmtUnit(currTxt, currFont)
+            tmpUnit = FmtUnit(currTxt, currFont, currUnits)
             self.accumUnits.append(tmpUnit)
             self.spaceLens.append(0)
 
+        self.computeLength()
+
+    def computeLength(self):
         self.length = (sum([unit.length for unit in self.accumUnits]) +
                        sum(self.spaceLens))
 
-    def rescale(self, scale):
-        self.maxHeight = int(self.maxHeight * scale)
-        self.spaceLens = [length * scale for length in self.spaceLens]
+    def measure(self):
         for unit in self.accumUnits:
-            unit.setLength()
-        self.length = (sum([unit.length for unit in self.accumUnits]) +
-                       sum(self.spaceLens))
+            unit.measure()
+        self.computeLength()
+
+    def scaled(self, scale, scaleFont):
+        # A copy of the line at `scale` times the size holding the same text, drawn
+        # with the fonts `scaleFont` maps each of the line's fonts to
+        line = copy.copy(self)
+        line.maxHeight = max(1, round(self.maxHeight * scale))
+        line.accumUnits = [FmtUnit(unit.txt, scaleFont(unit.font), unit.units)
+                           for unit in self.accumUnits]
+        line.spaceLens = [spaceLen * scale for spaceLen in self.spaceLens]
+        line._extent = None
+        line.measure()
+        return line
 
     def drawLine(self, d, x, y):
-        for (spaceLen, unit) in zip(self.spaceLens, self.accumUnits):
-            unit.drawUnit(d, x, y)
-            x += unit.length + spaceLen
+        # Inks the line's masks from `LineCache` the way `ImageDraw.text()` would
+        # draw each unit: its stroke, if any, and then its fill
+        for (i, stroked, (dx, dy), mask) in LineCache.get(self, d, x, y):
+            font = self.accumUnits[i].font
+            d.bitmap((int(x) + dx, int(y) + dy), mask,
+                     font.strokeRgba if stroked else font.rgba)
+
+    def reaches(self, y, clip):
+        # Whether the line, with its baseline at `y`, draws into the rows (top,
+        # bottom) of `clip`. How far its ink reaches above and below the baseline is
+        # found once per line.
+        if self._extent is None:
+            self._extent = (0, 0)
+            for unit in self.accumUnits:
+                (_, top, _, bottom) = unit.font.font.getbbox(
+                    unit.txt, anchor="ls", stroke_width=unit.font.stroke)
+                self._extent = (min(self._extent[0], top), max(self._extent[1], bottom))
+        return clip[0] <= y + self._extent[1] and y + self._extent[0] <= clip[1]
 
     def isNewline(self):
         return self.length == 0
 
 def wrapRegions(fmtWords, width):
-    Logging.subSection("Wrapping parsed text")
     formattedLines = []
     currLen = 0
     currWords = []
@@ -322,6 +480,85 @@ def wrapRegions(fmtWords, width):
 
     return formattedLines
 
+def wrapRegionsOptimal(fmtWords, width):
+    def breakParagraph(words):
+        # spaces[k] is the space rendered before words[k] when it doesn't start a line
+        spaces = [0]
+        for k in range(1, len(words)):
+            spaces.append(min(words[k-1].fmtUnits[-1].font.spaceLen,
+                              words[k].fmtUnits[-1].font.spaceLen))
+        # With prefix sums over word and space lengths, the length of the line holding
+        # words[i:j] is lineEnds[j] - lineStarts[i].
+        (wordSum, spaceSum) = (0, 0)
+        (lineStarts, lineEnds) = ([], [0])
+        for (word, space) in zip(words, spaces):
+            lineStarts.append(wordSum + spaceSum + space)
+            wordSum += word.actualLength
+            spaceSum += space
+            lineEnds.append(wordSum + spaceSum)
+
+        # cost[j] is the minimum raggedness of breaking words[:j] into lines, where a
+        # line's raggedness is the square of its unused width. The last line of a
+        # paragraph is free. Candidate lines stop growing once they overflow the
+        # width, so each word only looks back about one line's worth of words.
+        numWords = len(words)
+        cost = [0] + [float("inf")] * numWords
+        lineStart = [0] * (numWords + 1)
+        for j in range(1, numWords + 1):
+            (lineEnd, bestCost, bestStart) = (lineEnds[j], float("inf"), j - 1)
+            for i in range(j - 1, -1, -1):
+                lineLen = lineEnd - lineStarts[i]
+                if lineLen > width and i < j - 1:
+                    break
+                slack = width - lineLen if j < numWords and lineLen < width else 0
+                if cost[i] + slack * slack < bestCost:
+                    (bestCost, bestStart) = (cost[i] + slack * slack, i)
+            (cost[j], lineStart[j]) = (bestCost, bestStart)
+
+        breaks = []
+        j = numWords
+        while j > 0:
+            breaks.append((lineStart[j], j))
+            j = lineStart[j]
+        breaks.reverse()
+
+        for (i, j) in breaks:
+            words[i].spaceLength = 0
+            for k in range(i + 1, j):
+                words[k].spaceLength = spaces[k]
+        return [words[i:j] for (i, j) in breaks]
+
+    def wrapParagraph(words, carryHeight):
+        lines = []
+        for lineWords in breakParagraph(words):
+            maxHeight = max([word.maxHeight() for word in lineWords])
+            lines.append(FormattedLine(lineWords, max(maxHeight, carryHeight)))
+            carryHeight = 0
+        return lines
+
+    formattedLines = []
+    paragraph = []
+    # Like `wrapRegions()`, the first line after a newline is at least as tall as the
+    # font that was active when the newline was entered.
+    carryHeight = 0
+
+    for fmtWord in fmtWords:
+        if not fmtWord.isNewline():
+            paragraph.append(fmtWord)
+            continue
+
+        if paragraph:
+            formattedLines += wrapParagraph(paragraph, carryHeight)
+        else:
+            formattedLines.append(FormattedLine([], carryHeight))
+        paragraph = []
+        carryHeight = fmtWord.maxHeight()
+
+    if paragraph:
+        formattedLines += wrapParagraph(paragraph, carryHeight)
+
+    return formattedLines
+
 class TextBox:
     class Align:
         LEFT = "left"
@@ -333,64 +570,126 @@ class TextBox:
         self.baseHeight = baseHeight
         self.lineSpacing = lineSpacing
         self.padding = padding
+        # Lines are laid out as if the longest were at least this long (see `widen()`)
+        self.minLineLen = 0
 
         if fmtLines:
-            self.maxLineLen = max([line.length for line in fmtLines])
             self.averageFontHeight = int(sum([line.maxHeight for line in fmtLines])/len(fmtLines))
         else:
-            self.maxLineLen = 0
             self.averageFontHeight = 0
 
         self.computeDimensions()
 
+    def measure(self):
+        # Replaces the scaled lengths used for layout with exact ones. Only widths
+        # change, since line heights come from the font heights.
+        for line in self.fmtLines:
+            line.measure()
+        self.computeDimensions()
+
     def computeDimensions(self):
+        self.maxLineLen = max([line.length for line in self.fmtLines] + [self.minLineLen])
         self.width = ceil(self.maxLineLen + (self.padding * 2))
 
         self.height = self.padding * 2
         for line in self.fmtLines:
             self.height += self.lineSpacing + line.maxHeight
 
-    def split(self):
-        def reversedList(reversedIt):
-            return list(reversed(reversedIt))
-
-        def splitForward(lFmtLines, rFmtLines):
-            for line in list(rFmtLines):
-                if line.isNewline():
-                    rFmtLines.pop(0)
+    def split(self, columns=2):
+        # Splits into `columns` boxes at paragraph breaks (whose blank lines are
+        # dropped), picking the breaks that make the tallest box as short as possible
+        # and, of those, the shortest box as tall as possible. Both are binary searched
+        # over the box heights, with prefix sums of the line heights giving any box's
+        # height in O(1). Columns without a break to start them are left empty.
+        prefixHeights = [0]
+        for line in self.fmtLines:
+            prefixHeights.append(prefixHeights[-1] + self.lineSpacing + line.maxHeight)
+        totalHeight = prefixHeights[-1]
+        breaks = [i for (i, line) in enumerate(self.fmtLines) if line.isNewline()]
+        numCuts = min(columns - 1, len(breaks))
+        # Heights above the end of the box cut at each break, and above the start of
+        # the box after it
+        ends = [prefixHeights[i] for i in breaks]
+        starts = [prefixHeights[i + 1] for i in breaks]
+
+        def fitsUnder(tallest):
+            # Cutting every box at the last break it fits before leaves the least
+            # height for the boxes after it
+            (start, prev) = (0, -1)
+            for _ in range(numCuts):
+                cut = bisect_right(ends, start + tallest, prev + 1) - 1
+                if cut <= prev:
                     break
-                lFmtLines.append(rFmtLines.pop(0))
-            return [lFmtLines, rFmtLines]
-
-        Logging.subSection("Splitting wrapped text")
-        splitA = splitForward(self.fmtLines[:int(len(self.fmtLines)/2)],
-                              self.fmtLines[int(len(self.fmtLines)/2):])
-        splitB = splitForward(reversedList(self.fmtLines[int(len(self.fmtLines)/2):]),
-                              reversedList(self.fmtLines[:int(len(self.fmtLines)/2)]))
-        splitB = [reversedList(fmtLines) for fmtLines in reversed(splitB)]
-
-        splitADiff = abs(len(splitA[0]) - len(splitA[1]))
-        splitBDiff = abs(len(splitB[0]) - len(splitB[1]))
-        splitToUse = splitA if splitADiff <= splitBDiff else splitB
-
-        return [TextBox(splitToUse[0], self.baseHeight, self.lineSpacing, self.padding),
-                TextBox(splitToUse[1], self.baseHeight, self.lineSpacing, self.padding)]
-
-    def rescale(self, scale):
-        for fmtLine in self.fmtLines:
-            fmtLine.rescale(scale)
-
-        if self.fmtLines:
-            self.maxLineLen = max([line.length for line in self.fmtLines])
-        self.lineSpacing = int(self.lineSpacing * scale)
-        self.padding = int(self.padding * scale)
+                (start, prev) = (starts[cut], cut)
+            return totalHeight - start <= tallest
+
+        def cutsBetween(shortest, tallest):
+            # The earliest cuts whose boxes are all between `shortest` and `tallest`
+            # tall, or None. reachable[k][b] is whether the first k + 1 boxes can end
+            # at breaks[b], counted cumulatively so any range of breaks is O(1).
+            def window(end, lo, hi):
+                # Breaks in [lo, hi) that the box ending at `end` can start after
+                return (bisect_left(starts, end - tallest, lo, hi),
+                        bisect_right(starts, end - shortest, lo, hi))
+
+            reachable = [[shortest <= end <= tallest for end in ends]]
+            counts = []
+            for k in range(1, numCuts):
+                counts.append([0])
+                for canEnd in reachable[-1]:
+                    counts[-1].append(counts[-1][-1] + canEnd)
+                layer = [False] * len(breaks)
+                for b in range(k, len(breaks)):
+                    (lo, hi) = window(ends[b], k - 1, b)
+                    layer[b] = lo < hi and counts[-1][hi] > counts[-1][lo]
+                reachable.append(layer)
+
+            (lo, hi) = window(totalHeight, numCuts - 1, len(breaks))
+            if True not in reachable[-1][lo:hi]:
+                return None
+            cuts = [reachable[-1].index(True, lo, hi)]
+            for k in range(numCuts - 1, 0, -1):
+                (lo, hi) = window(ends[cuts[-1]], k - 1, cuts[-1])
+                cuts.append(reachable[k - 1].index(True, lo, hi))
+            return [breaks[b] for b in reversed(cuts)]
+
+        cuts = []
+        if numCuts > 0:
+            (lo, hi) = (0, totalHeight)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                (lo, hi) = (lo, mid) if fitsUnder(mid) else (mid + 1, hi)
+            tallest = lo
+            (lo, hi) = (0, tallest)
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                (lo, hi) = (mid, hi) if cutsBetween(mid, tallest) is not None \
+                           else (lo, mid - 1)
+            cuts = cutsBetween(lo, tallest)
+
+        starts = [0] + [cut + 1 for cut in cuts]
+        ends = cuts + [len(self.fmtLines)]
+        boxes = [TextBox(self.fmtLines[start:end], self.baseHeight, self.lineSpacing,
+                         self.padding) for (start, end) in zip(starts, ends)]
+        while len(boxes) < columns:
+            boxes.append(TextBox([], self.baseHeight, self.lineSpacing, self.padding))
+        return boxes
+
+    def widen(self, lineLen):
+        # Sizes and aligns the box as if its longest line were at least `lineLen`
+        # long, e.g. so that every page of a series is the same width
+        self.minLineLen = lineLen
         self.computeDimensions()
 
-        if self.fmtLines:
-            self.averageFontHeight = \
-                int(sum([line.maxHeight for line in self.fmtLines])/len(self.fmtLines))
+    def scaled(self, scale, scaleFont):
+        # A copy of the box at `scale` times the size with exactly the same lines
+        box = TextBox([line.scaled(scale, scaleFont) for line in self.fmtLines],
+                      max(1, round(self.baseHeight * scale)),
+                      round(self.lineSpacing * scale), round(self.padding * scale))
+        box.widen(self.minLineLen * scale)
+        return box
 
-    def drawText(self, d, alignment, startX=0, startY=0):
+    def drawText(self, d, alignment, startX=0, startY=0, clip=None):
         (x, y) = (startX + self.padding,
                   startY + self.padding - int(0.2 * self.averageFontHeight))
         for fmtLine in self.fmtLines:
@@ -400,5 +699,6 @@ class TextBox:
             elif alignment == self.Align.RIGHT:
                 x += self.maxLineLen - fmtLine.length
 
-            fmtLine.drawLine(d, x, y)
+            if clip is None or fmtLine.reaches(y, clip):
+                fmtLine.drawLine(d, x, y)
             (x, y) = (startX + self.padding, y + self.lineSpacing)